@@ -0,0 +1,146 @@
+"""Load synthetic users, places and reviews for benchmarking.
+
+Places are clustered around UK city centres the way real submissions are,
+with a share scattered across the country. Rows are streamed into the
+database with COPY in chunks, so scales of 10k to 10M rows fit in memory.
+
+    python -m benchmarks.generate --database postgres://... \\
+        --users 10000 --locations 100000 --reviews 1000000 --reset
+"""
+import io
+import random
+import time
+
+import click
+from werkzeug.security import generate_password_hash
+
+from places import create_app
+from places.db import (get_db, init_db, rebuild_rankings,
+                       rebuild_rating_summaries)
+
+# Name, lat, lng and share of clustered places
+CITIES = (
+    ('London', 51.5074, -0.1278, 0.35),
+    ('Birmingham', 52.4862, -1.8904, 0.1),
+    ('Manchester', 53.4808, -2.2426, 0.1),
+    ('Glasgow', 55.8642, -4.2518, 0.08),
+    ('Leeds', 53.8008, -1.5491, 0.08),
+    ('Edinburgh', 55.9533, -3.1883, 0.08),
+    ('Bristol', 51.4545, -2.5879, 0.08),
+    ('Cambridge', 52.2053, 0.1218, 0.07),
+    ('Cardiff', 51.4816, -3.1791, 0.06),
+)
+# Bounding box of Great Britain for scattered places
+UK_BOUNDS = (50.0, 58.6, -5.7, 1.7)
+# Share of places not clustered around a city
+SCATTERED = 0.1
+# Spread of a city's places in degrees (roughly 5km)
+CITY_SPREAD = 0.05
+
+WORDS = ('pub', 'cafe', 'park', 'museum', 'gallery', 'bridge', 'church',
+         'market', 'garden', 'library', 'castle', 'theatre', 'river', 'view',
+         'bakery', 'bookshop', 'cinema', 'brewery', 'square', 'tower')
+PASSWORD = 'password'
+CHUNK_ROWS = 50000
+
+
+def user_email(user_id):
+    return f'user{user_id}@bench.example'
+
+
+def random_point(rng):
+    if rng.random() < SCATTERED:
+        south, north, west, east = UK_BOUNDS
+        return rng.uniform(south, north), rng.uniform(west, east)
+    _, lat, lng, _ = rng.choices(CITIES, weights=[c[3] for c in CITIES])[0]
+    return rng.gauss(lat, CITY_SPREAD), rng.gauss(lng, CITY_SPREAD)
+
+
+def random_postcode(rng):
+    letters = 'ABCDEFGHJKLMNPRSTUWYZ'
+    return (f'{rng.choice(letters)}{rng.choice(letters)}{rng.randint(1, 99)} '
+            f'{rng.randint(0, 9)}{rng.choice(letters)}{rng.choice(letters)}')
+
+
+def copy_rows(cur, table, columns, rows):
+    """COPY rows into table, CHUNK_ROWS at a time."""
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write('\t'.join(str(value) for value in row) + '\n')
+        count += 1
+        if count % CHUNK_ROWS == 0:
+            buffer.seek(0)
+            cur.copy_expert(f'COPY {table} ({columns}) FROM STDIN', buffer)
+            buffer = io.StringIO()
+            click.echo(f'{table}: {count} rows')
+    buffer.seek(0)
+    cur.copy_expert(f'COPY {table} ({columns}) FROM STDIN', buffer)
+    return count
+
+
+def generate(users, locations, reviews, seed=0):
+    rng = random.Random(seed)
+    conn = get_db()
+    cur = conn.cursor()
+    # Hashing is deliberately slow, so every user shares one hash
+    password_hash = generate_password_hash(PASSWORD)
+    cur.execute('SELECT COALESCE(MAX(id), 0) AS id FROM users')
+    first_user = cur.fetchone()['id'] + 1
+    copy_rows(cur, 'users', 'email, password',
+              ((user_email(i), password_hash)
+               for i in range(first_user, first_user + users)))
+    cur.execute('SELECT MIN(id) AS low, MAX(id) AS high FROM users')
+    user_ids = cur.fetchone()
+
+    def place_rows():
+        for i in range(locations):
+            lat, lng = random_point(rng)
+            words = ' '.join(rng.sample(WORDS, 3))
+            yield (rng.randint(user_ids['low'], user_ids['high']),
+                   f'{rng.choice(WORDS).title()} {i}',
+                   f'A {words} worth visiting.', random_postcode(rng),
+                   round(lat, 6), round(lng, 6))
+    copy_rows(cur, 'locations', 'user_id, name, description, postcode, '
+              'lat, lng', place_rows())
+    cur.execute('SELECT MIN(id) AS low, MAX(id) AS high FROM locations')
+    location_ids = cur.fetchone()
+
+    def review_rows():
+        for _ in range(reviews):
+            yield (rng.randint(user_ids['low'], user_ids['high']),
+                   rng.randint(location_ids['low'], location_ids['high']),
+                   min(5, max(1, round(rng.gauss(3.5, 1)))),
+                   rng.choice(WORDS).title() + ' was good.')
+    copy_rows(cur, 'reviews', 'user_id, location_id, rating, review',
+              review_rows())
+    conn.commit()
+    rebuild_rating_summaries()
+    rebuild_rankings()
+    conn.autocommit = True
+    cur.execute('ANALYZE')
+    conn.autocommit = False
+
+
+@click.command()
+@click.option('--database', required=True, help='Postgres DSN to load.')
+@click.option('--users', default=1000)
+@click.option('--locations', default=10000)
+@click.option('--reviews', default=50000)
+@click.option('--seed', default=0, help='Random seed, for repeatable data.')
+@click.option('--reset', is_flag=True,
+              help='Recreate the schema before loading, deleting all data.')
+def main(database, users, locations, reviews, seed, reset):
+    """Generate a synthetic data set for the benchmarks."""
+    app = create_app({'TESTING': True, 'DATABASE': database})
+    with app.app_context():
+        if reset:
+            init_db()
+        started = time.monotonic()
+        generate(users, locations, reviews, seed)
+        click.echo(f'Loaded {users} users, {locations} places and '
+                   f'{reviews} reviews in {time.monotonic() - started:.1f}s.')
+
+
+if __name__ == '__main__':
+    main()
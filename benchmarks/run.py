@@ -0,0 +1,222 @@
+"""Measure latency and throughput of the main endpoints.
+
+Requests go through the Flask test client by default, or to a running
+server such as gunicorn with --url. Results are written as JSON and can be
+compared with an earlier run to spot regressions between commits.
+
+    python -m benchmarks.run --database postgres://... --output new.json \\
+        --compare old.json
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import http.cookiejar
+import json
+import random
+import re
+import subprocess
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import click
+
+from benchmarks.generate import CITIES, PASSWORD, user_email, WORDS
+from places import create_app
+from places.db import get_db
+
+SCENARIOS = ('locations', 'viewport', 'search', 'place', 'login')
+CSRF_TOKEN = re.compile(rb'name="_csrf_token" type="hidden" value="([^"]+)"')
+
+
+class TestClientSession:
+    """Issue requests in process through the Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+class HTTPSession:
+    """Issue requests to a running server, handling cookies and CSRF."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect())
+
+    def _open(self, request):
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def get(self, path):
+        return self._open(self.url + path)
+
+    def post(self, path, data):
+        # Fetch the form first for a CSRF token, this isn't timed
+        with self.opener.open(self.url + path) as response:
+            token = CSRF_TOKEN.search(response.read())
+        if token:
+            data = dict(data, _csrf_token=token.group(1).decode())
+        return self.timed(lambda: self._open(urllib.request.Request(
+            self.url + path, urllib.parse.urlencode(data).encode())))
+
+    def timed(self, request):
+        started = time.perf_counter()
+        status = request()
+        self.last_elapsed = time.perf_counter() - started
+        return status
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def make_request(scenario, rng, counts):
+    """Return a (method, path, form data) tuple for one request."""
+    city = rng.choice(CITIES)
+    lat = rng.gauss(city[1], 0.05)
+    lng = rng.gauss(city[2], 0.05)
+    if scenario == 'locations':
+        return 'GET', f'/locations?lat={lat:.5f}&lng={lng:.5f}', None
+    if scenario == 'viewport':
+        # Roughly the area a zoom 13 map shows
+        return 'GET', (f'/locations?north={lat + 0.03:.5f}'
+                       f'&south={lat - 0.03:.5f}&east={lng + 0.06:.5f}'
+                       f'&west={lng - 0.06:.5f}&zoom=13'), None
+    if scenario == 'search':
+        return 'POST', '/search', {'name': '',
+                                   'description': rng.choice(WORDS),
+                                   'postcode': ''}
+    if scenario == 'place':
+        return 'GET', f'/place/{rng.randint(1, counts["locations"])}', None
+    return 'POST', '/auth/login', {
+        'email': user_email(rng.randint(1, counts['users'])),
+        'password': PASSWORD}
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(sorted_values) - 1,
+                       round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(scenario, new_session, requests, concurrency, counts, seed):
+    rng = random.Random(seed)
+    work = [make_request(scenario, rng, counts) for _ in range(requests)]
+
+    def worker(chunk):
+        session = new_session()
+        results = []
+        for method, path, data in chunk:
+            started = time.perf_counter()
+            if method == 'GET':
+                status = session.get(path)
+                elapsed = time.perf_counter() - started
+            else:
+                status = session.post(path, data)
+                elapsed = getattr(session, 'last_elapsed',
+                                  time.perf_counter() - started)
+            results.append((elapsed, status))
+        return results
+
+    chunks = [work[i::concurrency] for i in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = [result for chunk in executor.map(worker, chunks)
+                   for result in chunk]
+    wall = time.perf_counter() - started
+    latencies = sorted(elapsed * 1000 for elapsed, _ in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, status in results if status >= 400),
+        'throughput_rps': round(requests / wall, 1),
+        'mean_ms': round(sum(latencies) / len(latencies), 2),
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--database', required=True,
+              help='Postgres DSN loaded by benchmarks.generate.')
+@click.option('--url', help='Benchmark a running server instead of the '
+              'Flask test client.')
+@click.option('--scenario', 'scenarios', multiple=True,
+              type=click.Choice(SCENARIOS), help='Defaults to all.')
+@click.option('--requests', default=500, help='Requests per scenario.')
+@click.option('--concurrency', default=1, help='Concurrent clients.')
+@click.option('--seed', default=0)
+@click.option('--output', type=click.Path(), help='Write results as JSON.')
+@click.option('--compare', type=click.Path(exists=True),
+              help='Earlier results to compare against.')
+def main(database, url, scenarios, requests, concurrency, seed, output,
+         compare):
+    """Benchmark the main endpoints against a generated data set."""
+    # Slow request logging would be measured too, so turn it off
+    app = create_app({'TESTING': True, 'DATABASE': database,
+                      'DATABASE_POOL_MAX': max(10, concurrency),
+                      'SLOW_REQUEST_MS': float('inf'),
+                      'SLOW_REQUEST_QUERIES': float('inf')})
+    with app.app_context():
+        cur = get_db().cursor()
+        cur.execute("""SELECT (SELECT MAX(id) FROM users) AS users,
+                              (SELECT MAX(id) FROM locations) AS locations""")
+        counts = dict(cur.fetchone())
+
+    if url:
+        new_session = lambda: HTTPSession(url)
+    else:
+        new_session = lambda: TestClientSession(app)
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'mode': url or 'test-client',
+        'concurrency': concurrency,
+        'scenarios': {},
+    }
+    previous = {}
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['scenarios']
+    for scenario in scenarios or SCENARIOS:
+        stats = run_scenario(scenario, new_session, requests, concurrency,
+                             counts, seed)
+        results['scenarios'][scenario] = stats
+        line = (f'{scenario:10} {stats["throughput_rps"]:8.1f} req/s  '
+                f'p50 {stats["p50_ms"]:8.2f}ms  p95 {stats["p95_ms"]:8.2f}ms'
+                f'  p99 {stats["p99_ms"]:8.2f}ms  errors {stats["errors"]}')
+        if scenario in previous:
+            change = (stats['p95_ms'] / previous[scenario]['p95_ms'] - 1
+                      if previous[scenario]['p95_ms'] else 0)
+            line += f'  p95 {change:+.0%} vs {compare}'
+        click.echo(line)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
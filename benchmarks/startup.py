@@ -0,0 +1,90 @@
+"""Measure import time and cold start of the app.
+
+Every sample runs in a fresh interpreter, like a newly booted gunicorn
+worker or test process, and times importing places, create_app() and
+the first request, which opens the connection pool.
+
+    python -m benchmarks.startup --database postgres://... --output new.json \\
+        --compare old.json
+"""
+from datetime import datetime, timezone
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+from benchmarks.run import git_commit, percentile
+
+SAMPLE = """
+import json, sys, time
+started = time.perf_counter()
+import places
+imported = time.perf_counter()
+app = places.create_app({'TESTING': True, 'DATABASE': sys.argv[1]})
+created = time.perf_counter()
+status = app.test_client().get('/locations?lat=52.2&lng=0.12').status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'modules': len(sys.modules),
+    'status': status}))
+"""
+
+METRICS = ('process_ms', 'import_ms', 'create_app_ms', 'first_request_ms',
+           'modules')
+
+
+def sample(database):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', SAMPLE, database],
+                            capture_output=True, text=True, check=True)
+    result = json.loads(output.stdout)
+    result['process_ms'] = (time.perf_counter() - started) * 1000
+    if result['status'] >= 400:
+        raise click.ClickException(f'First request failed with '
+                                   f'{result["status"]}.')
+    return result
+
+
+@click.command()
+@click.option('--database', required=True, help='Postgres DSN to connect to.')
+@click.option('--repeat', default=20, help='Interpreters to start.')
+@click.option('--output', type=click.Path(), help='Write results as JSON.')
+@click.option('--compare', type=click.Path(exists=True),
+              help='Earlier results to compare against.')
+def main(database, repeat, output, compare):
+    """Time starting the app from a fresh interpreter."""
+    samples = [sample(database) for _ in range(repeat)]
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'repeat': repeat,
+        'metrics': {},
+    }
+    previous = {}
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['metrics']
+    for metric in METRICS:
+        values = sorted(s[metric] for s in samples)
+        stats = {'median': round(statistics.median(values), 2),
+                 'p95': round(percentile(values, 0.95), 2)}
+        results['metrics'][metric] = stats
+        line = (f'{metric:17} median {stats["median"]:9.2f}  '
+                f'p95 {stats["p95"]:9.2f}')
+        if previous.get(metric, {}).get('median'):
+            change = stats['median'] / previous[metric]['median'] - 1
+            line += f'  median {change:+.0%} vs {compare}'
+        click.echo(line)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
 import os
 
-from flask import Flask
+# Cooperative mode has to patch the standard library before anything
+# else is imported, see places/green.py
+if os.getenv('PLACES_GREEN'):
+    from places.green import patch
+    patch()
+
+from flask import Flask  # noqa: E402
 
 
 def create_app(test_config=None):
@@ -8,6 +14,116 @@ def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
     app.config['SECRET_KEY'] = 'dev'
     app.config['DATABASE'] = os.getenv('DATABASE_URL')
+    # Per-process connection pool sizing, checkout timeout and the idle
+    # time after which a pooled connection is pinged before reuse
+    app.config['DATABASE_POOL_MIN'] = int(os.getenv('DATABASE_POOL_MIN', 1))
+    app.config['DATABASE_POOL_MAX'] = int(os.getenv('DATABASE_POOL_MAX', 10))
+    app.config['DATABASE_POOL_TIMEOUT'] = float(
+        os.getenv('DATABASE_POOL_TIMEOUT', 30))
+    app.config['DATABASE_POOL_CHECK_INTERVAL'] = float(
+        os.getenv('DATABASE_POOL_CHECK_INTERVAL', 30))
+    # Tests only: run all queries on one shared connection inside a
+    # transaction that is rolled back when the next test's app first
+    # uses it, see db.get_test_connection
+    app.config['TEST_TRANSACTIONAL'] = False
+    # Optional read replica DSNs, comma separated, that read-only queries
+    # are spread over. A replica that fails is skipped for
+    # DATABASE_REPLICA_RETRY seconds, and sessions read from the primary
+    # for DATABASE_READ_YOUR_WRITES seconds after writing
+    app.config['DATABASE_REPLICAS'] = [
+        dsn.strip() for dsn in os.getenv('DATABASE_REPLICAS', '').split(',')
+        if dsn.strip()]
+    app.config['DATABASE_REPLICA_RETRY'] = float(
+        os.getenv('DATABASE_REPLICA_RETRY', 30))
+    app.config['DATABASE_READ_YOUR_WRITES'] = float(
+        os.getenv('DATABASE_READ_YOUR_WRITES', 10))
+    # Upper bound on the number of places a single /locations call returns,
+    # and a higher one for streamed calls, which use constant memory
+    app.config['LOCATIONS_MAX_LIMIT'] = int(
+        os.getenv('LOCATIONS_MAX_LIMIT', 2000))
+    app.config['LOCATIONS_STREAM_MAX_LIMIT'] = int(
+        os.getenv('LOCATIONS_STREAM_MAX_LIMIT', 100000))
+    # Rows fetched per round-trip when streaming /locations
+    app.config['LOCATIONS_STREAM_ITERSIZE'] = int(
+        os.getenv('LOCATIONS_STREAM_ITERSIZE', 1000))
+    # Requests taking longer than this many milliseconds or running more
+    # queries than this are logged with their slowest statements
+    app.config['SLOW_REQUEST_MS'] = int(os.getenv('SLOW_REQUEST_MS', 500))
+    app.config['SLOW_REQUEST_QUERIES'] = int(
+        os.getenv('SLOW_REQUEST_QUERIES', 20))
+    # Viewport queries: results per page and the zoom below which
+    # locations are returned as grid clusters
+    app.config['LOCATIONS_PAGE_SIZE'] = int(
+        os.getenv('LOCATIONS_PAGE_SIZE', 500))
+    app.config['LOCATIONS_CLUSTER_ZOOM'] = int(
+        os.getenv('LOCATIONS_CLUSTER_ZOOM', 10))
+    # Outbox delivery: attempts per email and the initial retry delay in
+    # seconds, doubled after every failed attempt
+    app.config['EMAIL_MAX_ATTEMPTS'] = int(os.getenv('EMAIL_MAX_ATTEMPTS', 5))
+    app.config['EMAIL_RETRY_DELAY'] = int(os.getenv('EMAIL_RETRY_DELAY', 30))
+    # Response cache: entries kept in process, seconds before entries
+    # expire (capped at CACHE_MEMORY_TTL without redis, as invalidations
+    # don't reach other processes), an optional redis URL to share the
+    # cache between processes and the lat/lng grid /locations centres are
+    # snapped to
+    app.config['CACHE_SIZE'] = int(os.getenv('CACHE_SIZE', 1000))
+    app.config['CACHE_TTL'] = int(os.getenv('CACHE_TTL', 300))
+    app.config['CACHE_MEMORY_TTL'] = int(os.getenv('CACHE_MEMORY_TTL', 5))
+    app.config['CACHE_REDIS_URL'] = os.getenv('CACHE_REDIS_URL')
+    app.config['LOCATIONS_TILE_SIZE'] = float(
+        os.getenv('LOCATIONS_TILE_SIZE', 0.01))
+    # Top places: geohash length of the ranking cells (5 is roughly
+    # 5km square), the Bayesian prior mean rating and how many reviews it
+    # counts as, and the most places /top returns. Run rebuild-rankings
+    # after changing the first three
+    app.config['RANKING_PRECISION'] = int(os.getenv('RANKING_PRECISION', 5))
+    app.config['RANKING_PRIOR_MEAN'] = float(
+        os.getenv('RANKING_PRIOR_MEAN', 3))
+    app.config['RANKING_PRIOR_WEIGHT'] = float(
+        os.getenv('RANKING_PRIOR_WEIGHT', 5))
+    app.config['TOP_PLACES_LIMIT'] = int(os.getenv('TOP_PLACES_LIMIT', 20))
+    # Password hashing method and cost, e.g. 'pbkdf2:sha256:600000', and
+    # salt length, Werkzeug's defaults when unset. Stored hashes are
+    # upgraded on login when these change
+    app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD')
+    app.config['PASSWORD_SALT_LENGTH'] = int(
+        os.getenv('PASSWORD_SALT_LENGTH', 0)) or None
+    # Threads hashing passwords per process, how many more requests may
+    # wait for one and for how many seconds before a 503 is returned
+    app.config['PASSWORD_HASH_WORKERS'] = int(
+        os.getenv('PASSWORD_HASH_WORKERS', 2))
+    app.config['PASSWORD_HASH_QUEUE'] = int(
+        os.getenv('PASSWORD_HASH_QUEUE', 8))
+    app.config['PASSWORD_HASH_TIMEOUT'] = float(
+        os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+    # Group commit: when set, reviews and places are inserted by a writer
+    # thread per process that commits the writes arriving within
+    # WRITE_BATCH_WINDOW milliseconds, up to WRITE_BATCH_SIZE, together.
+    # Requests wait up to WRITE_BATCH_TIMEOUT seconds for their commit
+    app.config['WRITE_BATCHING'] = bool(int(os.getenv('WRITE_BATCHING', 0)))
+    app.config['WRITE_BATCH_WINDOW'] = float(
+        os.getenv('WRITE_BATCH_WINDOW', 5))
+    app.config['WRITE_BATCH_SIZE'] = int(os.getenv('WRITE_BATCH_SIZE', 100))
+    app.config['WRITE_BATCH_TIMEOUT'] = float(
+        os.getenv('WRITE_BATCH_TIMEOUT', 30))
+    # Logged in users are cached per process for this many seconds
+    app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 10000))
+    app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 60))
+    # Number of results per page of search results and of reviews
+    app.config['SEARCH_PAGE_SIZE'] = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+    app.config['REVIEWS_PAGE_SIZE'] = int(os.getenv('REVIEWS_PAGE_SIZE', 20))
+    # Optional ONS Postcode Directory style CSV of postcode centroids,
+    # consulted before the geocoder below
+    app.config['GAZETTEER_PATH'] = os.getenv('GAZETTEER_PATH')
+    # Postcode geocoding: the geocoder callable (Google Maps when None),
+    # in-process cache size and seconds to cache hits and misses for
+    app.config['GEOCODER'] = None
+    app.config['GEOCODE_CACHE_SIZE'] = int(
+        os.getenv('GEOCODE_CACHE_SIZE', 10000))
+    app.config['GEOCODE_CACHE_TTL'] = int(
+        os.getenv('GEOCODE_CACHE_TTL', 30 * 24 * 60 * 60))
+    app.config['GEOCODE_NEGATIVE_TTL'] = int(
+        os.getenv('GEOCODE_NEGATIVE_TTL', 24 * 60 * 60))
 
     if test_config is None:
         # Load the instance config, if it exists, when not testing
@@ -27,7 +143,11 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import email
+    email.init_app(app)
+
     from . import auth
+    app.app_ctx_globals_class = auth.AppGlobals
     app.register_blueprint(auth.bp)
 
     from . import places
@@ -36,9 +156,19 @@ def create_app(test_config=None):
     from . import errors
     app.register_blueprint(errors.bp)
 
+    from . import metrics
+    app.register_blueprint(metrics.bp)
+
     app.add_url_rule('/', endpoint='index')
 
     return app
 
 
-app = create_app()
+def __getattr__(name):
+    # Build ``places.app`` on first access rather than on import, so CLI
+    # commands and tests that call create_app() don't build one as well
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
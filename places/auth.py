@@ -1,13 +1,17 @@
 import functools
 import secrets
 
-from flask import (abort, Blueprint, current_app, Flask, flash, g, redirect,
-                   render_template, request, session, url_for, make_response)
+from flask import (abort, Blueprint, current_app, Flask, flash, g,
+                   has_request_context, redirect, render_template, request,
+                   session, url_for, make_response)
+from flask.ctx import _AppCtxGlobals
 from itsdangerous import URLSafeSerializer
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from places.db import get_db
-from places.email import send_email
+from places import queries
+from places.cache import LRUCache
+from places.db import commit
+from places.email import queue_email
+from places.passwords import check_password, hash_password, needs_rehash
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -20,20 +24,50 @@ def send_password_reset_email(user_email):
         _external=True
     )
     text = f'Please use the URL below to reset your password:\n{url}'
-    send_email(subject='Reset your password',
-               recipients=[user_email],
-               text_body=text)
+    queue_email(subject='Reset your password',
+                recipients=[user_email],
+                text_body=text)
+
+
+class AppGlobals(_AppCtxGlobals):
+    """Application globals that only look up ``g.user`` when it is used.
+
+    Requests that never touch ``g.user``, such as the AJAX location
+    endpoints, then don't need a database round-trip for the user.
+    """
+
+    def __getattr__(self, name):
+        if name == 'user':
+            self.user = load_logged_in_user()
+            return self.user
+        raise AttributeError(name)
+
+
+def _user_cache():
+    cache = current_app.extensions.get('user_cache')
+    if cache is None:
+        cache = LRUCache(current_app.config['USER_CACHE_SIZE'])
+        current_app.extensions['user_cache'] = cache
+    return cache
 
 
-@bp.before_app_request
 def load_logged_in_user():
-    user_id = session.get('user_id')
+    """Return the logged in user's id and email, or None."""
+    user_id = session.get('user_id') if has_request_context() else None
     if user_id is None:
-        g.user = None
-    else:
-        cur = get_db().cursor()
-        cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-        g.user = cur.fetchone()
+        return None
+    cache = _user_cache()
+    found, user = cache.get(user_id)
+    if not found:
+        user = queries.user_by_id(user_id)
+        # A missing user may just not have reached a replica yet
+        if user is not None:
+            cache.set(user_id, user, current_app.config['USER_CACHE_TTL'])
+    return user
+
+
+def invalidate_user(user_id):
+    _user_cache().delete(user_id)
 
 
 @bp.before_app_request
@@ -70,18 +104,13 @@ def register():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
-        conn = get_db()
-        cur = conn.cursor()
         error = ('Email is required.' if not email else
                  'Password is required.' if not password else None)
-        cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-        if cur.fetchone() is not None:
+        if queries.user_by_email(email) is not None:
             error = f'User {email} is already registered.'
         if error is None:
-            cur.execute(
-                'INSERT INTO users (email, password) VALUES (%s, %s)',
-                (email, generate_password_hash(password)))
-            conn.commit()
+            queries.add_user(email, hash_password(password))
+            commit()
             session['email'] = email
             flash('Account creation successful! Please log in below.')
             return redirect(url_for('auth.login'))
@@ -94,18 +123,24 @@ def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
-        conn = get_db()
-        cur = conn.cursor()
         error = None
-        cur.execute('SELECT * FROM users WHERE email = %s', (email,))
-        user = cur.fetchone()
+        user = queries.user_by_email(email)
         if user is None:
             error = 'Incorrect email.'
-        elif not check_password_hash(user['password'], password):
+        elif not check_password(user.password, password):
             error = 'Incorrect password.'
         if error is None:
+            if needs_rehash(user.password):
+                # Move the stored hash to the configured method and cost
+                queries.set_password(user.id, hash_password(password))
+                commit()
+            # Keep reading from the primary after the rehash or a recent
+            # registration, which replicas may not have yet
+            written_at = session.get('db_written_at')
             session.clear()
-            session['user_id'] = user['id']
+            session['user_id'] = user.id
+            if written_at is not None:
+                session['db_written_at'] = written_at
             return redirect(url_for('index'))
         flash(error)
     return render_template('auth/login.html')
@@ -123,6 +158,10 @@ def reset_password():
     """Reset password route, accessed from link on login page."""
     if request.method == 'POST':
         email = request.form['email']
+        # A line break would let the address add headers to the email
+        if '\r' in email or '\n' in email:
+            flash('Invalid email address.')
+            return render_template('auth/reset_password.html')
         send_password_reset_email(email)
         flash('Password reset email sent! Please check your inbox.')
         return redirect(url_for('auth.login'))
@@ -137,19 +176,15 @@ def new_password(token=None):
         # to login
         email = session['email']
         password = request.form['password']
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-        user = cur.fetchone()
+        user = queries.user_by_email(email)
         error = ('Password is required.' if not password else
                  f'User {email} not found.' if not user else None)
         if error:
             flash(error)
         else:
-            cur.execute(
-                'UPDATE users SET password = %s WHERE id = %s',
-                (generate_password_hash(password), user['id']))
-            conn.commit()
+            queries.set_password(user.id, hash_password(password))
+            commit()
+            invalidate_user(user.id)
             flash('Password succesfully updated!')
         return redirect(url_for('auth.login'))
 
@@ -160,12 +195,10 @@ def new_password(token=None):
     except:
         flash('The reset password link is invalid or has expired.')
         return redirect(url_for('auth.login'))
-    cur = get_db().cursor()
-    cur.execute("SELECT id, email FROM users WHERE email = %s", (email,))
-    user = cur.fetchone()
+    user = queries.user_by_email(email)
     if not user:
         flash(f'User {email} not found.')
         return redirect(url_for('auth.login'))
-    session['email'] = user['email']
+    session['email'] = user.email
     flash('Please enter your new password below.')
     return render_template('auth/new_password.html')
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from flask import current_app
+
+from places.db import wrote_recently
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a TTL per entry."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (True, value) for a fresh entry, else (False, None)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class MemoryCache:
+    """Response cache local to this process.
+
+    Invalidations only reach the process that made the change, so other
+    processes keep serving an entry for up to ``max_ttl`` seconds, however
+    long it was set for.
+    """
+
+    def __init__(self, maxsize, max_ttl):
+        self._lru = LRUCache(maxsize)
+        self.max_ttl = max_ttl
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._lru.get(key)[1]
+
+    def set(self, key, value, ttl):
+        self._lru.set(key, value, min(ttl, self.max_ttl))
+
+    def delete(self, key):
+        self._lru.delete(key)
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class RedisCache:
+    """Response cache shared between processes through redis.
+
+    Values are stored as JSON so must be JSON serialisable.
+    """
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('CACHE_REDIS_URL is set but the redis package '
+                               'is not installed.')
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        self._client.set(key, json.dumps(value), ex=int(ttl))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def counter(self, key):
+        return int(self._client.get(key) or 0)
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+
+def get_cache():
+    """Return the response cache for the current app."""
+    cache = current_app.extensions.get('response_cache')
+    if cache is None:
+        url = current_app.config['CACHE_REDIS_URL']
+        cache = (RedisCache(url) if url else
+                 MemoryCache(current_app.config['CACHE_SIZE'],
+                             current_app.config['CACHE_MEMORY_TTL']))
+        current_app.extensions['response_cache'] = cache
+    return cache
+
+
+def cached(key, build):
+    """Return the cached value for key, calling build() on a miss.
+
+    Sessions that wrote recently read from the primary (see
+    ``db.get_db``), so they skip the cache, which may have been refilled
+    from a lagging replica since their write, and don't store what they
+    read.
+    """
+    if wrote_recently():
+        return build()
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, current_app.config['CACHE_TTL'])
+    return value
+
+
+def locations_generation():
+    """Return a number that changes whenever any location data changes.
+
+    Location tile keys include it, so bumping it invalidates every tile
+    without having to know which tiles a change falls in.
+    """
+    return get_cache().counter('locations:generation')
+
+
+def invalidate_locations():
+    get_cache().incr('locations:generation')
+
+
+def invalidate_place(place_id):
+    get_cache().delete(f'place:{place_id}')
+    invalidate_locations()
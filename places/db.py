@@ -1,25 +1,400 @@
+import itertools
+import logging
 import os
+import threading
+import time
 
 import click
-from flask import current_app, g
+from flask import current_app, g, has_request_context, session
 from flask.cli import with_appcontext
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2 import extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError
 
+from places.geo import geohash
+from places.metrics import InstrumentedCursor
 
-def get_db():
-    """Return postgres connection object."""
+logger = logging.getLogger(__name__)
+
+# Seconds to wait when connecting to a replica before falling back
+REPLICA_CONNECT_TIMEOUT = 5
+
+
+class Connection(extensions.connection):
+    """Connection that remembers which statements it has prepared."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class TestConnection(Connection):
+    """Connection whose work is all undone at the end of each test.
+
+    Used in place of the pool when ``TEST_TRANSACTIONAL`` is set. The
+    real transaction only ends in ``reset``, ``commit`` and ``rollback``
+    act on a savepoint inside it, so code under test can commit and roll
+    back as usual while nothing reaches the database.
+    """
+
+    owner = None
+
+    def _savepoint(self, sql):
+        # A plain cursor, so these don't count as queries in the metrics
+        with self.cursor(cursor_factory=extensions.cursor) as cur:
+            cur.execute(sql)
+
+    def commit(self):
+        self._savepoint('RELEASE SAVEPOINT test; SAVEPOINT test')
+
+    def rollback(self):
+        self._savepoint('ROLLBACK TO SAVEPOINT test')
+
+    def reset(self, owner=None):
+        """Discard everything done since the last reset."""
+        super().rollback()
+        # Start each test without the previous test's prepared statements
+        with self.cursor(cursor_factory=extensions.cursor) as cur:
+            cur.execute('DEALLOCATE ALL')
+        self.prepared.clear()
+        super().commit()
+        self._savepoint('SAVEPOINT test')
+        self.owner = owner
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out in time."""
+
+
+class ConnectionPool:
+    """Thread-safe pool of postgres connections for a single process.
+
+    Connections are checked for liveness on checkout (a ``SELECT 1`` is
+    only issued once a connection has sat idle longer than
+    ``check_interval`` seconds) and any open transaction is rolled back
+    when a connection is returned.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=30.0,
+                 check_interval=30.0, **connect_kwargs):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.connect_kwargs = connect_kwargs
+        self.pid = os.getpid()
+        self._idle = []  # (connection, returned_at) pairs, newest last
+        self._in_use = set()
+        self._opening = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stats = {'connects': 0, 'checkouts': 0, 'waits': 0,
+                       'timeouts': 0, 'discarded': 0, 'rollbacks': 0}
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(dsn=self.dsn, **self.connect_kwargs)
+        self._stats['connects'] += 1
+        return conn
+
+    def _discard(self, conn):
+        self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _healthy(self, conn, idle_since):
+        """Return True if conn is usable, pinging it if idle for long."""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _reserve(self, deadline):
+        """Claim an idle connection or a slot for a new one.
+
+        Must be called with the pool lock held. Returns ``(conn,
+        idle_since)`` for an idle connection or ``(None, None)`` when the
+        caller should open a new connection in the reserved slot.
+        """
+        while True:
+            if self._closed:
+                raise PoolError('connection pool is closed')
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+                self._in_use.add(conn)
+                return conn, idle_since
+            if len(self._in_use) + self._opening < self.maxconn:
+                self._opening += 1
+                return None, None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._stats['timeouts'] += 1
+                raise PoolTimeout(
+                    f'No connection available after {self.timeout}s '
+                    f'({self.maxconn} in use).')
+            self._stats['waits'] += 1
+            self._cond.wait(remaining)
+
+    def getconn(self):
+        """Check out a connection, waiting up to ``timeout`` seconds."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                conn, idle_since = self._reserve(deadline)
+            if conn is None:
+                # Connect outside the lock so other checkouts can proceed
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        if conn is not None:
+                            self._in_use.add(conn)
+                            self._stats['checkouts'] += 1
+                        self._cond.notify()
+                return conn
+            if self._healthy(conn, idle_since):
+                with self._cond:
+                    self._stats['checkouts'] += 1
+                return conn
+            with self._cond:
+                self._in_use.discard(conn)
+                self._discard(conn)
+                self._cond.notify()
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool, rolling back open work."""
+        with self._cond:
+            self._in_use.discard(conn)
+            if not close and not conn.closed:
+                status = conn.get_transaction_status()
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                        self._stats['rollbacks'] += 1
+                    except psycopg2.Error:
+                        close = True
+            if (close or conn.closed or self._closed
+                    or len(self._idle) >= self.maxconn):
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return a snapshot of pool size and usage counters."""
+        with self._cond:
+            return dict(self._stats, idle=len(self._idle),
+                        in_use=len(self._in_use), min_size=self.minconn,
+                        max_size=self.maxconn)
+
+
+_pool_lock = threading.Lock()
+
+
+def _new_pool(app, dsn, **connect_kwargs):
+    return ConnectionPool(
+        dsn,
+        minconn=app.config['DATABASE_POOL_MIN'],
+        maxconn=app.config['DATABASE_POOL_MAX'],
+        timeout=app.config['DATABASE_POOL_TIMEOUT'],
+        check_interval=app.config['DATABASE_POOL_CHECK_INTERVAL'],
+        connection_factory=Connection,
+        cursor_factory=InstrumentedCursor,
+        **connect_kwargs)
+
+
+def get_pool(app=None):
+    """Return the connection pool for this app and process.
+
+    The pool is created lazily so that forked gunicorn workers each open
+    their own connections rather than sharing the master's sockets.
+    """
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get('db_pool')
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        pool = app.extensions.get('db_pool')
+        if pool is not None and pool.pid == os.getpid():
+            return pool
+        pool = _new_pool(app, app.config['DATABASE'])
+        app.extensions['db_pool'] = pool
+        return pool
+
+
+def pool_stats():
+    """Return usage statistics for the current app's connection pool."""
+    return get_pool().stats()
+
+
+class Replica:
+    """A read replica, its connection pool and whether it is usable.
+
+    A replica that can't be connected to is skipped for
+    ``DATABASE_REPLICA_RETRY`` seconds before being tried again.
+    """
+
+    def __init__(self, app, dsn):
+        self.app = app
+        self.dsn = dsn
+        self.pool = None
+        self.down_until = 0
+
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+    def getconn(self):
+        try:
+            if self.pool is None:
+                with _pool_lock:
+                    if self.pool is None:
+                        self.pool = _new_pool(
+                            self.app, self.dsn,
+                            connect_timeout=REPLICA_CONNECT_TIMEOUT)
+            return self.pool.getconn()
+        except (psycopg2.OperationalError, PoolTimeout):
+            logger.warning('Replica %s unavailable, using others.',
+                           self.dsn.rsplit('@', 1)[-1])
+            self.down_until = (time.monotonic() +
+                               self.app.config['DATABASE_REPLICA_RETRY'])
+            return None
+
+
+def get_replicas(app=None):
+    """Return this process's replicas, created like ``get_pool``."""
+    app = app or current_app._get_current_object()
+    replicas = app.extensions.get('db_replicas')
+    if replicas is None or replicas['pid'] != os.getpid():
+        with _pool_lock:
+            replicas = app.extensions.get('db_replicas')
+            if replicas is None or replicas['pid'] != os.getpid():
+                replicas = {
+                    'pid': os.getpid(),
+                    'replicas': [Replica(app, dsn) for dsn in
+                                 app.config['DATABASE_REPLICAS']],
+                    'next': itertools.count()}
+                app.extensions['db_replicas'] = replicas
+    return replicas
+
+
+def _replica_connection():
+    """Check out a connection from a healthy replica, or return None."""
+    replicas = get_replicas()
+    count = len(replicas['replicas'])
+    start = next(replicas['next'])
+    for i in range(count):
+        replica = replicas['replicas'][(start + i) % count]
+        if replica.healthy():
+            conn = replica.getconn()
+            if conn is not None:
+                return replica, conn
+    return None
+
+
+def wrote_recently():
+    """Whether this session wrote within DATABASE_READ_YOUR_WRITES."""
+    if not has_request_context():
+        return False
+    written_at = session.get('db_written_at')
+    return (written_at is not None and time.time() - written_at <
+            current_app.config['DATABASE_READ_YOUR_WRITES'])
+
+
+_test_connections = {}
+
+
+def get_test_connection(app=None):
+    """Return the connection shared by tests in TEST_TRANSACTIONAL mode.
+
+    One connection per database is kept open for the whole test run and
+    reset whenever a new app starts using it, so each test (which builds
+    its own app) starts from the committed data.
+    """
+    app = app or current_app._get_current_object()
+    dsn = app.config['DATABASE']
+    conn = _test_connections.get(dsn)
+    if conn is None or conn.closed:
+        conn = _test_connections[dsn] = psycopg2.connect(
+            dsn=dsn, connection_factory=TestConnection,
+            cursor_factory=InstrumentedCursor)
+    if conn.owner is not app:
+        conn.reset(owner=app)
+    return conn
+
+
+def get_db(readonly=False):
+    """Return postgres connection object.
+
+    With ``readonly`` a connection to one of ``DATABASE_REPLICAS`` is
+    returned instead, unless none are configured or healthy, the request
+    already uses the primary or the session wrote recently (see
+    ``commit``).
+    """
+    if current_app.config['TEST_TRANSACTIONAL']:
+        if 'db' not in g:
+            g.db = get_test_connection()
+        return g.db
+    if readonly and 'db' not in g and not wrote_recently():
+        if 'db_replica' not in g:
+            g.db_replica = _replica_connection()
+        if g.db_replica is not None:
+            return g.db_replica[1]
     if 'db' not in g:
-        g.db = psycopg2.connect(dsn=current_app.config['DATABASE'],
-                                cursor_factory=DictCursor)
+        g.db = get_pool().getconn()
     return g.db
 
 
+def commit():
+    """Commit the request's writes to the primary.
+
+    The session then reads from the primary for the next
+    ``DATABASE_READ_YOUR_WRITES`` seconds, so users see their own
+    changes even if the replicas are behind.
+    """
+    get_db().commit()
+    mark_written()
+
+
+def mark_written():
+    """Read this session from the primary for a while after a write."""
+    if has_request_context():
+        session['db_written_at'] = time.time()
+
+
 def close_db(e=None):
-    """Close database connection."""
+    """Return database connections to their pools."""
     db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    if isinstance(db, TestConnection):
+        # Like putconn, drop anything the request didn't commit
+        db.rollback()
+    elif db is not None:
+        get_pool().putconn(db)
+    replica = g.pop('db_replica', None)
+    if replica is not None:
+        replica[0].pool.putconn(replica[1])
 
 
 def init_db():
@@ -28,9 +403,63 @@ def init_db():
     with open(
             os.path.join(os.path.dirname(__file__), 'schema.sql'), 'rb') as f:
         _data_sql = f.read().decode('utf-8')
-        with get_db() as conn:
+        conn = get_db()
+        with conn:
             conn.cursor().execute(_data_sql)
-        conn.close()
+
+
+def rebuild_rating_summaries():
+    """Recompute every location's review count and rating sum."""
+    conn = get_db()
+    with conn:
+        conn.cursor().execute("""
+            UPDATE locations
+            SET review_count = summary.review_count,
+                rating_sum = summary.rating_sum
+            FROM (SELECT locations.id,
+                         COUNT(reviews.id) AS review_count,
+                         COALESCE(SUM(reviews.rating), 0) AS rating_sum
+                  FROM locations
+                      LEFT JOIN reviews
+                      ON reviews.location_id = locations.id
+                  GROUP BY locations.id) AS summary
+            WHERE summary.id = locations.id""")
+
+
+def ranking_row(location_id, lat, lng, review_count, rating_sum):
+    """Return the (cell, location_id, score) place_rankings row of a place.
+
+    The score is a Bayesian average: the mean rating as if the place also
+    had ``RANKING_PRIOR_WEIGHT`` reviews of ``RANKING_PRIOR_MEAN``, so a
+    single 5 star review doesn't outrank hundreds averaging 4.8.
+    """
+    config = current_app.config
+    weight = config['RANKING_PRIOR_WEIGHT']
+    score = ((weight * config['RANKING_PRIOR_MEAN'] + rating_sum) /
+             (weight + review_count))
+    return (geohash(lat, lng, config['RANKING_PRECISION']), location_id,
+            score)
+
+
+def rebuild_rankings(batch_size=10000):
+    """Recompute place_rankings from the location rating summaries."""
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        cur.execute('TRUNCATE place_rankings')
+        with conn.cursor(name='rebuild_rankings') as places:
+            places.execute("""
+                SELECT id, lat, lng, review_count, rating_sum
+                FROM locations
+                WHERE review_count > 0""")
+            while True:
+                rows = places.fetchmany(batch_size)
+                if not rows:
+                    break
+                execute_values(cur, """
+                    INSERT INTO place_rankings (cell, location_id, score)
+                    VALUES %s""", [ranking_row(*row) for row in rows],
+                    page_size=len(rows))
 
 
 @click.command('init-db')
@@ -41,6 +470,47 @@ def init_db_command():
     click.echo('Initialised the database.')
 
 
+@click.command('rebuild-ratings')
+@with_appcontext
+def rebuild_ratings_command():
+    """Recompute location rating summaries from the reviews table."""
+    rebuild_rating_summaries()
+    click.echo('Rebuilt rating summaries.')
+
+
+@click.command('rebuild-rankings')
+@with_appcontext
+def rebuild_rankings_command():
+    """Recompute the top places rankings, e.g. after changing RANKING_*."""
+    rebuild_rankings()
+    click.echo('Rebuilt place rankings.')
+
+
+@click.command('import-data')
+@click.option('--places', 'places_path', type=click.Path(exists=True),
+              help='CSV or JSON lines file of places.')
+@click.option('--reviews', 'reviews_path', type=click.Path(exists=True),
+              help='CSV or JSON lines file of reviews.')
+@click.option('--batch-size', default=1000,
+              help='Records inserted per transaction.')
+@click.option('--restart', is_flag=True,
+              help='Ignore checkpoints from earlier runs.')
+@with_appcontext
+def import_data_command(places_path, reviews_path, batch_size, restart):
+    """Bulk load places and reviews, resuming interrupted imports."""
+    from places.importer import import_file
+
+    for kind, path in (('places', places_path), ('reviews', reviews_path)):
+        if path is not None:
+            imported, skipped = import_file(path, kind, batch_size, restart,
+                                            echo=click.echo)
+            click.echo(f'Imported {imported} {kind} from {path}'
+                       f' ({skipped} skipped).')
+
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(rebuild_ratings_command)
+    app.cli.add_command(rebuild_rankings_command)
+    app.cli.add_command(import_data_command)
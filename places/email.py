@@ -1,11 +1,18 @@
-from email.message import EmailMessage
 import os
-import smtplib
-import ssl
+import time
 
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+import psycopg2
+
+from places.db import close_db, get_db
+
+
+def build_message(subject, recipients, text_body, html_body=None,
+                  sender=os.environ.get('MAIL_DEFAULT_SENDER')):
+    from email.message import EmailMessage
 
-def send_email(subject, recipients, text_body, html_body=None,
-               sender=os.environ.get('MAIL_DEFAULT_SENDER')):
     msg = EmailMessage()
     msg['Subject'] = subject
     msg['From'] = sender
@@ -13,11 +20,171 @@ def send_email(subject, recipients, text_body, html_body=None,
     msg.set_content(text_body)
     if html_body:
         msg.add_alternative(html_body, subtype='html')
-    context = ssl.create_default_context()
-
-    with smtplib.SMTP_SSL(host=os.environ.get('MAIL_SERVER'),
-                          port=os.environ.get('MAIL_PORT'),
-                          context=context) as server:
-        server.login(os.environ.get('MAIL_USERNAME'),
-                     os.environ.get('MAIL_PASSWORD'))
-        server.send_message(msg)
+    return msg
+
+
+class Mailer:
+    """SMTP connection that is opened lazily and reused across messages.
+
+    Settings default to the MAIL_* environment variables. Set MAIL_USE_SSL
+    to 0 to talk plain SMTP, e.g. to a local debugging server, in which
+    case no login is attempted unless MAIL_USERNAME is set.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_ssl=None, timeout=30):
+        self.host = host or os.environ.get('MAIL_SERVER')
+        self.port = int(port or os.environ.get('MAIL_PORT') or 0)
+        self.username = username or os.environ.get('MAIL_USERNAME')
+        self.password = password or os.environ.get('MAIL_PASSWORD')
+        if use_ssl is None:
+            use_ssl = os.environ.get('MAIL_USE_SSL', '1') != '0'
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self._server = None
+
+    def _connect(self):
+        # Only the email worker sends mail, so web workers never load these
+        import smtplib
+        import ssl
+
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(host=self.host, port=self.port,
+                                      timeout=self.timeout,
+                                      context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(host=self.host, port=self.port,
+                                  timeout=self.timeout)
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    def send(self, msg):
+        """Send msg, reconnecting once if the server dropped us."""
+        import smtplib
+
+        if self._server is None:
+            self._server = self._connect()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self._server = self._connect()
+            self._server.send_message(msg)
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except OSError:  # Includes smtplib.SMTPException
+                pass
+            self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def send_email(subject, recipients, text_body, html_body=None,
+               sender=os.environ.get('MAIL_DEFAULT_SENDER')):
+    """Send an email immediately over a new SMTP connection."""
+    with Mailer() as mailer:
+        mailer.send(build_message(subject, recipients, text_body,
+                                  html_body, sender))
+
+
+def queue_email(subject, recipients, text_body, html_body=None,
+                sender=os.environ.get('MAIL_DEFAULT_SENDER')):
+    """Add an email to the outbox for delivery by the email worker."""
+    conn = get_db()
+    conn.cursor().execute("""
+        INSERT INTO email_outbox (subject, sender, recipients, text_body,
+                                  html_body)
+        VALUES (%s, %s, %s, %s, %s)""",
+        (subject, sender, ', '.join(recipients), text_body, html_body))
+    conn.commit()
+
+
+def deliver_pending(mailer, batch_size=50):
+    """Send up to batch_size due emails from the outbox, return how many.
+
+    Each email is claimed, sent and marked in its own transaction, so a
+    later failure can't undo the record of one already sent. Failed
+    messages, including ones that can't be built, are retried after
+    EMAIL_RETRY_DELAY seconds, doubling with each attempt, until
+    EMAIL_MAX_ATTEMPTS is reached. Rows are locked with SKIP LOCKED so
+    several workers can share the outbox.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    tried = []
+    sent = 0
+    while len(tried) < batch_size:
+        cur.execute("""
+            SELECT id, subject, sender, recipients, text_body, html_body,
+                   attempts
+            FROM email_outbox
+            WHERE sent_at IS NULL AND attempts < %s
+                AND next_attempt_at <= NOW() AND id <> ALL(%s::INTEGER[])
+            ORDER BY next_attempt_at, id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED""",
+            (current_app.config['EMAIL_MAX_ATTEMPTS'], tried))
+        row = cur.fetchone()
+        if row is None:
+            break
+        tried.append(row['id'])
+        try:
+            mailer.send(build_message(
+                row['subject'], row['recipients'].split(', '),
+                row['text_body'], row['html_body'], row['sender']))
+        except Exception as e:
+            if isinstance(e, OSError):  # Includes smtplib.SMTPException
+                mailer.close()
+            delay = (current_app.config['EMAIL_RETRY_DELAY'] *
+                     2 ** row['attempts'])
+            cur.execute("""
+                UPDATE email_outbox
+                SET attempts = attempts + 1, last_error = %s,
+                    next_attempt_at = NOW() + %s * INTERVAL '1 second'
+                WHERE id = %s""", (repr(e), delay, row['id']))
+        else:
+            sent += 1
+            cur.execute("""
+                UPDATE email_outbox
+                SET attempts = attempts + 1, sent_at = NOW()
+                WHERE id = %s""", (row['id'],))
+        conn.commit()
+    return sent
+
+
+@click.command('email-worker')
+@click.option('--once', is_flag=True,
+              help='Deliver the emails currently due and exit.')
+@click.option('--interval', default=5.0,
+              help='Seconds to wait between polls of an empty outbox.')
+@click.option('--batch-size', default=50)
+@with_appcontext
+def email_worker_command(once, interval, batch_size):
+    """Deliver queued emails over a reused SMTP connection."""
+    with Mailer() as mailer:
+        while True:
+            try:
+                sent = deliver_pending(mailer, batch_size)
+            except psycopg2.Error:
+                # Keep polling, on a new connection, until the database
+                # is back
+                current_app.logger.exception('Email delivery failed')
+                close_db()
+                sent = 0
+            if sent:
+                click.echo(f'Sent {sent} email(s).')
+            if once:
+                break
+            if sent < batch_size:
+                time.sleep(interval)
+
+
+def init_app(app):
+    app.cli.add_command(email_worker_command)
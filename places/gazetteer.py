@@ -0,0 +1,124 @@
+from array import array
+from bisect import bisect_left
+import csv
+import threading
+
+from flask import current_app
+
+# Column names tried in order, covering the ONS Postcode Directory and
+# simpler postcode, latitude, longitude files
+POSTCODE_COLUMNS = ('pcds', 'pcd', 'postcode')
+LAT_COLUMNS = ('lat', 'latitude')
+LNG_COLUMNS = ('long', 'lng', 'longitude')
+# The ONS directory gives postcodes without a location this latitude
+NO_LOCATION = 99.999999
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+class _Incodes:
+    """Sequence view of the 3 byte incodes between start and end."""
+
+    def __init__(self, incodes, start, end):
+        self.incodes = incodes
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        offset = (self.start + i) * 3
+        return self.incodes[offset:offset + 3]
+
+
+class Gazetteer:
+    """Postcode centroids held in sorted arrays for offline geocoding.
+
+    Postcodes are sorted by outcode then incode. ``outcodes`` maps each
+    outcode to its range of entries, whose incodes are packed 3 bytes
+    each into ``incodes`` and binary searched, with the centroids in
+    parallel arrays of microdegrees. That's 11 bytes a postcode, around
+    30MB for the whole of the UK.
+    """
+
+    def __init__(self, entries):
+        """Build from (postcode, lat, lng) tuples, postcodes normalised."""
+        entries = sorted((postcode[:-3], postcode[-3:], lat, lng)
+                         for postcode, lat, lng in entries)
+        self.outcodes = {}
+        incodes = bytearray()
+        self.lats = array('i')
+        self.lngs = array('i')
+        for i, (outcode, incode, lat, lng) in enumerate(entries):
+            start, _ = self.outcodes.get(outcode, (i, i))
+            self.outcodes[outcode] = (start, i + 1)
+            incodes += incode.encode('ascii')
+            self.lats.append(round(lat * 1e6))
+            self.lngs.append(round(lng * 1e6))
+        self.incodes = bytes(incodes)
+
+    @classmethod
+    def from_csv(cls, path):
+        """Load an ONS Postcode Directory style CSV file.
+
+        Terminated postcodes and those without a location are skipped.
+        """
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            fields = reader.fieldnames or []
+            try:
+                postcode_col = next(c for c in POSTCODE_COLUMNS if c in fields)
+                lat_col = next(c for c in LAT_COLUMNS if c in fields)
+                lng_col = next(c for c in LNG_COLUMNS if c in fields)
+            except StopIteration:
+                raise ValueError(f'{path} has no postcode, latitude and '
+                                 f'longitude columns.')
+            entries = []
+            for row in reader:
+                if row.get('doterm') or not row[lat_col]:
+                    continue
+                lat, lng = float(row[lat_col]), float(row[lng_col])
+                if lat == NO_LOCATION:
+                    continue
+                postcode = ''.join(row[postcode_col].split()).upper()
+                if 5 <= len(postcode) <= 7 and postcode.isascii():
+                    entries.append((postcode, lat, lng))
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def lookup(self, postcode):
+        """Return (lat, lng) for a normalised postcode, or None.
+
+        See ``geocode.normalise_postcode``.
+        """
+        found = self.outcodes.get(postcode[:-3])
+        if found is None or not postcode.isascii():
+            return None
+        start, end = found
+        incode = postcode[-3:].encode('ascii')
+        i = start + bisect_left(_Incodes(self.incodes, start, end), incode)
+        if i == end or self.incodes[i * 3:i * 3 + 3] != incode:
+            return None
+        return self.lats[i] / 1e6, self.lngs[i] / 1e6
+
+
+def get_gazetteer():
+    """Return the gazetteer loaded from GAZETTEER_PATH, or None.
+
+    It is loaded on first use and shared by the whole process.
+    """
+    global _gazetteer
+    path = current_app.config['GAZETTEER_PATH']
+    if not path:
+        return None
+    gazetteer = _gazetteer
+    if gazetteer is not None and gazetteer[0] == path:
+        return gazetteer[1]
+    with _gazetteer_lock:
+        if _gazetteer is None or _gazetteer[0] != path:
+            _gazetteer = (path, Gazetteer.from_csv(path))
+        return _gazetteer[1]
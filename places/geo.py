@@ -0,0 +1,81 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def bounding_box(lat, lng, radius_km):
+    """Return (min_lat, max_lat, min_lng, max_lng) enclosing a circle."""
+    lat_delta = radius_km / KM_PER_DEGREE
+    # Degrees of longitude shrink towards the poles
+    cos_lat = math.cos(math.radians(min(abs(lat) + lat_delta, 90)))
+    lng_delta = (180 if cos_lat < 1e-9 else
+                 min(radius_km / (KM_PER_DEGREE * cos_lat), 180))
+    return (lat - lat_delta, lat + lat_delta,
+            lng - lng_delta, lng + lng_delta)
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(lat, lng, precision):
+    """Return the geohash of a point, ``precision`` characters long."""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    value = bits = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, longitude first
+        bounds, x = (lng_range, lng) if even else (lat_range, lat)
+        middle = (bounds[0] + bounds[1]) / 2
+        value <<= 1
+        if x >= middle:
+            value |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            value = bits = 0
+    return ''.join(chars)
+
+
+def geohash_bounds(cell):
+    """Return (min_lat, max_lat, min_lng, max_lng) of a geohash cell."""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            bounds = lng_range if even else lat_range
+            middle = (bounds[0] + bounds[1]) / 2
+            if value >> shift & 1:
+                bounds[0] = middle
+            else:
+                bounds[1] = middle
+            even = not even
+    return lat_range[0], lat_range[1], lng_range[0], lng_range[1]
+
+
+def geohash_neighbours(lat, lng, precision):
+    """Return the cell containing a point followed by the cells around it.
+
+    Usually 9 cells, fewer next to the poles.
+    """
+    min_lat, max_lat, min_lng, max_lng = geohash_bounds(
+        geohash(lat, lng, precision))
+    height, width = max_lat - min_lat, max_lng - min_lng
+    centre_lat, centre_lng = min_lat + height / 2, min_lng + width / 2
+    cells = []
+    for dlat, dlng in ((0, 0), (-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1),
+                       (1, -1), (1, 0), (1, 1)):
+        cell_lat = centre_lat + dlat * height
+        if not -90 < cell_lat < 90:
+            continue
+        cell_lng = (centre_lng + dlng * width + 180) % 360 - 180
+        cell = geohash(cell_lat, cell_lng, precision)
+        if cell not in cells:
+            cells.append(cell)
+    return cells
@@ -0,0 +1,165 @@
+import threading
+
+from flask import current_app
+from psycopg2.extras import execute_values
+
+from places.cache import LRUCache
+from places.db import get_db
+from places.gazetteer import get_gazetteer
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return a googlemaps client shared by the whole process."""
+    global _client
+    # googlemaps brings in requests, only load them when geocoding
+    import googlemaps
+
+    api_key = current_app.config.get('API_KEY')
+    with _client_lock:
+        if _client is None or _client.key != api_key:
+            _client = googlemaps.Client(key=api_key)
+        return _client
+
+
+def google_geocode(postcode):
+    """Geocode a postcode with the Google Maps API.
+
+    Return a (lat, lng) tuple, or None if the postcode was not found.
+    """
+    result = get_client().geocode('components=postal_code:' + postcode)
+    if not result:
+        return None
+    location = result[0]['geometry']['location']
+    return location['lat'], location['lng']
+
+
+def normalise_postcode(postcode):
+    """Return a postcode in upper case with all whitespace removed."""
+    return ''.join(postcode.split()).upper()
+
+
+def format_postcode(postcode):
+    """Return a postcode as stored, e.g. 'cb23qn' becomes 'CB2 3QN'."""
+    postcode = normalise_postcode(postcode)
+    # The incode is always the last 3 characters, the outcode the rest
+    return f'{postcode[:-3]} {postcode[-3:]}'
+
+
+def _memory_cache():
+    cache = current_app.extensions.get('geocode_cache')
+    if cache is None:
+        cache = LRUCache(current_app.config['GEOCODE_CACHE_SIZE'])
+        current_app.extensions['geocode_cache'] = cache
+    return cache
+
+
+def geocode(postcode):
+    """Return (lat, lng) for a postcode, or None if it can't be geocoded.
+
+    Postcodes are looked up in the gazetteer at ``GAZETTEER_PATH`` if one
+    is configured. Others go through an in-process LRU, then the
+    geocode_cache table and only then the configured ``GEOCODER``. Misses
+    are cached too, for ``GEOCODE_NEGATIVE_TTL`` seconds rather than
+    ``GEOCODE_CACHE_TTL``.
+    """
+    key = normalise_postcode(postcode)
+    gazetteer = get_gazetteer()
+    if gazetteer is not None:
+        coords = gazetteer.lookup(key)
+        if coords is not None:
+            return coords
+    memory = _memory_cache()
+    found, coords = memory.get(key)
+    if found:
+        return coords
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT lat, lng, EXTRACT(EPOCH FROM expires_at - NOW()) AS ttl
+        FROM geocode_cache
+        WHERE postcode = %s AND expires_at > NOW()""", (key,))
+    row = cur.fetchone()
+    if row is not None:
+        coords = (row['lat'], row['lng']) if row['lat'] is not None else None
+        memory.set(key, coords, float(row['ttl']))
+        return coords
+
+    geocoder = current_app.config['GEOCODER'] or google_geocode
+    coords = geocoder(key)
+    ttl = current_app.config['GEOCODE_CACHE_TTL' if coords else
+                             'GEOCODE_NEGATIVE_TTL']
+    lat, lng = coords if coords else (None, None)
+    cur.execute("""
+        INSERT INTO geocode_cache (postcode, lat, lng, expires_at)
+        VALUES (%s, %s, %s, NOW() + %s * INTERVAL '1 second')
+        ON CONFLICT (postcode) DO UPDATE
+        SET lat = EXCLUDED.lat, lng = EXCLUDED.lng,
+            expires_at = EXCLUDED.expires_at""", (key, lat, lng, ttl))
+    conn.commit()
+    memory.set(key, coords, ttl)
+    return coords
+
+
+def geocode_many(postcodes):
+    """Return a dict mapping each postcode to (lat, lng) or None.
+
+    Like ``geocode`` but looks up all postcodes missing from the
+    in-process cache with a single query and stores new results with a
+    single statement, for use when loading places in bulk.
+    """
+    keys = {postcode: normalise_postcode(postcode) for postcode in postcodes}
+    memory = _memory_cache()
+    coords = {}
+    gazetteer = get_gazetteer()
+    for key in set(keys.values()):
+        value = gazetteer.lookup(key) if gazetteer is not None else None
+        if value is not None:
+            coords[key] = value
+            continue
+        found, value = memory.get(key)
+        if found:
+            coords[key] = value
+
+    missing = [key for key in set(keys.values()) if key not in coords]
+    if missing:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT postcode, lat, lng,
+                   EXTRACT(EPOCH FROM expires_at - NOW()) AS ttl
+            FROM geocode_cache
+            WHERE postcode = ANY(%s) AND expires_at > NOW()""", (missing,))
+        for row in cur:
+            value = ((row['lat'], row['lng']) if row['lat'] is not None
+                     else None)
+            coords[row['postcode']] = value
+            memory.set(row['postcode'], value, float(row['ttl']))
+
+        geocoder = current_app.config['GEOCODER'] or google_geocode
+        new = []
+        for key in missing:
+            if key in coords:
+                continue
+            value = geocoder(key)
+            ttl = current_app.config['GEOCODE_CACHE_TTL' if value else
+                                     'GEOCODE_NEGATIVE_TTL']
+            coords[key] = value
+            memory.set(key, value, ttl)
+            lat, lng = value if value else (None, None)
+            new.append((key, lat, lng, ttl))
+        if new:
+            execute_values(cur, """
+                INSERT INTO geocode_cache (postcode, lat, lng, expires_at)
+                SELECT postcode, lat, lng,
+                       NOW() + ttl * INTERVAL '1 second'
+                FROM (VALUES %s) AS new (postcode, lat, lng, ttl)
+                ON CONFLICT (postcode) DO UPDATE
+                SET lat = EXCLUDED.lat, lng = EXCLUDED.lng,
+                    expires_at = EXCLUDED.expires_at""", new,
+                template='(%s, %s::REAL, %s::REAL, %s)')
+        conn.commit()
+    return {postcode: coords[key] for postcode, key in keys.items()}
@@ -0,0 +1,33 @@
+"""Cooperative mode: serve many concurrent requests per process.
+
+With ``PLACES_GREEN=1`` the standard library and psycopg2 are patched by
+gevent and psycogreen before anything else is imported, so a request
+waiting on Postgres, the geocoder or SMTP yields to others instead of
+blocking its worker. Run it with gevent workers:
+
+    PLACES_GREEN=1 gunicorn -k gevent --worker-connections 500 \
+        'places:create_app()'
+
+Views are unchanged, so the test suite runs the same in both modes.
+"""
+_patched = False
+
+
+def patch():
+    """Patch sockets, threads and psycopg2 to yield to other greenlets."""
+    global _patched
+    if _patched:
+        return
+    try:
+        from gevent import monkey
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        raise RuntimeError('PLACES_GREEN is set but gevent and psycogreen '
+                           'are not installed.')
+    monkey.patch_all()
+    patch_psycopg()
+    _patched = True
+
+
+def is_patched():
+    return _patched
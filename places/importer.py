@@ -0,0 +1,145 @@
+from collections import defaultdict
+import csv
+from itertools import islice
+import json
+import os
+import time
+
+from psycopg2.extras import execute_values
+
+from places.db import get_db, ranking_row
+from places.geocode import format_postcode, geocode_many
+
+
+def read_records(path):
+    """Yield the records of a .csv or .jsonl file as dicts."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _checkpoint(cur, source):
+    cur.execute("SELECT records FROM import_checkpoints WHERE source = %s",
+                (source,))
+    row = cur.fetchone()
+    return row['records'] if row else 0
+
+
+def _save_checkpoint(cur, source, records):
+    cur.execute("""
+        INSERT INTO import_checkpoints (source, records)
+        VALUES (%s, %s)
+        ON CONFLICT (source) DO UPDATE SET records = EXCLUDED.records""",
+        (source, records))
+
+
+def _place_rows(batch):
+    """Return insertable place tuples for a batch and the number skipped.
+
+    Geocoding commits its cache entries, so this must run before any of
+    the batch is inserted.
+    """
+    postcodes = [record['postcode'] for record in batch
+                 if not record.get('lat') or not record.get('lng')]
+    coords = geocode_many(postcodes) if postcodes else {}
+    rows = []
+    for record in batch:
+        if record.get('lat') and record.get('lng'):
+            lat, lng = float(record['lat']), float(record['lng'])
+        elif coords.get(record['postcode']):
+            lat, lng = coords[record['postcode']]
+        else:
+            continue
+        rows.append((int(record['user_id']), record['name'].strip(),
+                     record['description'].strip(),
+                     format_postcode(record['postcode']), lat, lng))
+    return rows, len(batch) - len(rows)
+
+
+def _insert_places(cur, batch):
+    rows, skipped = _place_rows(batch)
+    execute_values(cur, """
+        INSERT INTO locations (user_id, name, description, postcode,
+                               lat, lng)
+        VALUES %s""", rows, page_size=len(batch))
+    return skipped
+
+
+def insert_reviews(cur, batch):
+    """Insert reviews and update their places' summaries and rankings."""
+    rows = [(int(record['user_id']), int(record['location_id']),
+             int(record['rating']), record.get('review') or '')
+            for record in batch]
+    execute_values(cur, """
+        INSERT INTO reviews (user_id, location_id, rating, review)
+        VALUES %s""", rows, page_size=len(batch))
+    # Apply the batch to the rating summaries in the same transaction
+    summaries = defaultdict(lambda: [0, 0])
+    for _, location_id, rating, _ in rows:
+        summaries[location_id][0] += 1
+        summaries[location_id][1] += rating
+    execute_values(cur, """
+        UPDATE locations
+        SET review_count = locations.review_count + batch.review_count,
+            rating_sum = locations.rating_sum + batch.rating_sum,
+            updated_at = NOW()
+        FROM (VALUES %s) AS batch (id, review_count, rating_sum)
+        WHERE locations.id = batch.id""",
+        [(location_id, count, total)
+         for location_id, (count, total) in summaries.items()],
+        page_size=len(summaries))
+    cur.execute("""
+        SELECT id, lat, lng, review_count, rating_sum
+        FROM locations
+        WHERE id = ANY(%s)""", (list(summaries),))
+    execute_values(cur, """
+        INSERT INTO place_rankings (cell, location_id, score)
+        VALUES %s
+        ON CONFLICT (cell, location_id) DO UPDATE
+        SET score = EXCLUDED.score""",
+        [ranking_row(*row) for row in cur.fetchall()],
+        page_size=len(summaries))
+    return 0
+
+
+def import_file(path, kind, batch_size=1000, restart=False, echo=print):
+    """Load a places or reviews file in batches of batch_size records.
+
+    Places need ``user_id``, ``name``, ``description`` and ``postcode`` and
+    may give ``lat`` and ``lng``, otherwise the postcode is geocoded.
+    Reviews need ``user_id``, ``location_id``, ``rating`` and may give
+    ``review``.
+
+    Each batch is inserted and recorded in ``import_checkpoints`` in one
+    transaction, so a rerun resumes after the last committed batch unless
+    ``restart`` is set. Returns a (imported, skipped) tuple, skipped
+    counting places whose postcode could not be geocoded.
+    """
+    insert = {'places': _insert_places, 'reviews': insert_reviews}[kind]
+    source = f'{kind}:{os.path.abspath(path)}'
+    conn = get_db()
+    cur = conn.cursor()
+    done = 0 if restart else _checkpoint(cur, source)
+    conn.commit()
+    if done:
+        echo(f'Resuming {path} after {done} records.')
+    records = islice(read_records(path), done, None)
+    imported = skipped = 0
+    started = time.monotonic()
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        batch_skipped = insert(cur, batch)
+        done += len(batch)
+        _save_checkpoint(cur, source, done)
+        conn.commit()
+        imported += len(batch) - batch_skipped
+        skipped += batch_skipped
+        rate = (imported + skipped) / (time.monotonic() - started)
+        echo(f'{path}: {done} records processed ({rate:.0f}/s).')
+    return imported, skipped
@@ -0,0 +1,179 @@
+import heapq
+import logging
+import threading
+import time
+
+from flask import (Blueprint, current_app, g, has_app_context, request)
+from psycopg2.extras import DictCursor, NamedTupleCursor
+
+bp = Blueprint('metrics', __name__)
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of histogram buckets counting items, e.g. batch sizes
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Number of slowest statements kept per request for the slow request log
+SLOWEST_KEPT = 3
+
+
+class InstrumentedMixin:
+    """Cursor mixin that records the time taken by every statement."""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(query, time.perf_counter() - started)
+
+
+class InstrumentedCursor(InstrumentedMixin, DictCursor):
+    pass
+
+
+class InstrumentedTupleCursor(InstrumentedMixin, NamedTupleCursor):
+    pass
+
+
+def record_query(query, elapsed):
+    """Add a statement's duration to the current request's totals."""
+    if not has_app_context():
+        return
+    stats = g.get('query_stats')
+    if stats is None:
+        stats = g.query_stats = {'count': 0, 'time': 0.0, 'slowest': []}
+    stats['count'] += 1
+    stats['time'] += elapsed
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    entry = (elapsed, ' '.join(str(query).split())[:500])
+    if len(stats['slowest']) < SLOWEST_KEPT:
+        heapq.heappush(stats['slowest'], entry)
+    else:
+        heapq.heappushpop(stats['slowest'], entry)
+
+
+class Registry:
+    """Process-wide counters and histograms in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, bounds=BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            _, buckets, total = self.histograms.get(
+                key, (bounds, [0] * len(bounds), [0, 0.0]))
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    buckets[i] += 1
+            total[0] += 1
+            total[1] += value
+            self.histograms[key] = (bounds, buckets, total)
+
+    def render(self, gauges=()):
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{name}{_labels(labels)} {value}')
+            for (name, labels), (bounds, buckets, total) in sorted(
+                    self.histograms.items()):
+                for bound, count in zip(bounds, buckets):
+                    lines.append(f'{name}_bucket'
+                                 f'{_labels(labels + (("le", bound),))}'
+                                 f' {count}')
+                lines.append(f'{name}_bucket'
+                             f'{_labels(labels + (("le", "+Inf"),))}'
+                             f' {total[0]}')
+                lines.append(f'{name}_count{_labels(labels)} {total[0]}')
+                lines.append(f'{name}_sum{_labels(labels)} {total[1]}')
+        for name, value in gauges:
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def get_registry():
+    registry = current_app.extensions.get('metrics')
+    if registry is None:
+        registry = current_app.extensions['metrics'] = Registry()
+    return registry
+
+
+@bp.before_app_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request(response):
+    """Expose the request's SQL totals and log it if it was slow."""
+    if 'request_started' not in g:
+        return response
+    duration = time.perf_counter() - g.request_started
+    stats = g.get('query_stats') or {'count': 0, 'time': 0.0, 'slowest': []}
+    response.headers['Server-Timing'] = (
+        f'db;desc="{stats["count"]} queries";dur={stats["time"] * 1000:.1f}, '
+        f'total;dur={duration * 1000:.1f}')
+
+    endpoint = request.endpoint or 'unknown'
+    registry = get_registry()
+    registry.inc('places_requests_total',
+                 {'endpoint': endpoint, 'method': request.method,
+                  'status': response.status_code})
+    registry.observe('places_request_duration_seconds',
+                     {'endpoint': endpoint}, duration)
+    registry.inc('places_db_queries_total', {'endpoint': endpoint},
+                 stats['count'])
+    registry.inc('places_db_query_seconds_total', {'endpoint': endpoint},
+                 stats['time'])
+
+    config = current_app.config
+    if (stats['count'] > config['SLOW_REQUEST_QUERIES'] or
+            duration * 1000 > config['SLOW_REQUEST_MS']):
+        slowest = '; '.join(f'{elapsed * 1000:.1f}ms {query}'
+                            for elapsed, query in
+                            sorted(stats['slowest'], reverse=True))
+        logger.warning('Slow request %s %s: %.1fms, %d queries taking '
+                       '%.1fms. Slowest: %s', request.method, request.path,
+                       duration * 1000, stats['count'], stats['time'] * 1000,
+                       slowest)
+    return response
+
+
+@bp.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint for this worker process."""
+    gauges = []
+    pool = current_app.extensions.get('db_pool')
+    if pool is not None:
+        gauges = [(f'places_db_pool_{name}', value)
+                  for name, value in sorted(pool.stats().items())]
+    replicas = current_app.extensions.get('db_replicas')
+    for i, replica in enumerate(replicas['replicas'] if replicas else ()):
+        gauges.append((f'places_db_replica_healthy{{replica="{i}"}}',
+                       int(replica.healthy())))
+    return current_app.response_class(
+        get_registry().render(gauges),
+        mimetype='text/plain; version=0.0.4')
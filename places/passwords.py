@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import threading
+
+from flask import abort, current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from places.green import is_patched
+
+# Werkzeug's hashing defaults, which apply when the settings are unset
+_defaults = inspect.signature(generate_password_hash).parameters
+DEFAULT_METHOD = _defaults['method'].default
+DEFAULT_SALT_LENGTH = _defaults['salt_length'].default
+
+
+class HashingPool:
+    """Bounded pool of threads that hash and check passwords.
+
+    Hashing is CPU bound but hashlib releases the GIL while it runs, so
+    with threaded or gevent workers other requests keep being served
+    while a login waits on the pool. The calling request itself always
+    waits for its hash, so with sync workers the gain is only the
+    backpressure: at most ``workers + queue`` operations may be pending,
+    callers beyond that wait up to ``timeout`` seconds before a 503.
+    """
+
+    def __init__(self, workers, queue, timeout):
+        if is_patched():
+            # Patched threads are greenlets that would block the event
+            # loop while hashing, gevent's pool uses real threads
+            from gevent.threadpool import ThreadPoolExecutor as executor
+            self._executor = executor(max_workers=workers)
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self.timeout = timeout
+
+    def run(self, fn, *args, **kwargs):
+        """Run fn in the pool and return its result, or abort with 503."""
+        if not self._slots.acquire(timeout=self.timeout):
+            abort(503)
+        try:
+            return self._executor.submit(fn, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+
+
+def _pool():
+    pool = current_app.extensions.get('password_pool')
+    if pool is None:
+        config = current_app.config
+        pool = HashingPool(config['PASSWORD_HASH_WORKERS'],
+                           config['PASSWORD_HASH_QUEUE'],
+                           config['PASSWORD_HASH_TIMEOUT'])
+        current_app.extensions['password_pool'] = pool
+    return pool
+
+
+def hash_password(password):
+    """Hash a password with the configured method and salt length."""
+    kwargs = {}
+    if current_app.config['PASSWORD_HASH_METHOD']:
+        kwargs['method'] = current_app.config['PASSWORD_HASH_METHOD']
+    if current_app.config['PASSWORD_SALT_LENGTH']:
+        kwargs['salt_length'] = current_app.config['PASSWORD_SALT_LENGTH']
+    return _pool().run(generate_password_hash, password, **kwargs)
+
+
+def check_password(pwhash, password):
+    return _pool().run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    """Return True if pwhash wasn't made with the configured parameters.
+
+    Hashes are compared against PASSWORD_HASH_METHOD and
+    PASSWORD_SALT_LENGTH, or Werkzeug's defaults where those are unset.
+    Only the parts of the method that are given are compared, so
+    'pbkdf2:sha256' matches hashes of any iteration count while
+    'pbkdf2:sha256:600000' requires that exact count.
+    """
+    config = current_app.config
+    wanted = (config['PASSWORD_HASH_METHOD'] or DEFAULT_METHOD).split(':')
+    salt_length = config['PASSWORD_SALT_LENGTH'] or DEFAULT_SALT_LENGTH
+    method, salt, _ = pwhash.split('$', 2)
+    return (method.split(':')[:len(wanted)] != wanted
+            or len(salt) != salt_length)
@@ -1,14 +1,45 @@
+import hashlib
 import json
+import math
 
-import googlemaps
-from flask import (Blueprint, current_app, flash, g, redirect,
-                   render_template, request, session, url_for)
+from flask import (abort, Blueprint, current_app, flash, g, make_response,
+                   redirect, render_template, request, session,
+                   stream_with_context, url_for)
+from werkzeug.http import http_date, is_resource_modified
 
+from places import queries, writer
 from places.auth import login_required
-from places.db import get_db
+from places.cache import (cached, invalidate_locations, invalidate_place,
+                          locations_generation)
+from places.db import commit
+from places.geo import bounding_box, geohash_neighbours
+from places.geocode import format_postcode, geocode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 bp = Blueprint('places', __name__)
 
+# Highest zoom level of web maps, beyond which grid cells would shrink
+# towards zero
+MAX_ZOOM = 22
+
+
+def dumps(obj):
+    """Serialise obj to a JSON string, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
+
+
+def average_rating(review_count, rating_sum):
+    """Return a location's mean rating from its summary columns."""
+    if not review_count:
+        return None
+    return rating_sum / review_count
+
 
 @bp.route('/')
 def index():
@@ -21,47 +52,216 @@ def index():
                            api_key=api_key)
 
 
+def location_json(row):
+    """Return the JSON-serialisable form of a location row."""
+    average = average_rating(row.review_count, row.rating_sum)
+    return {
+        'id': row.id,
+        'name': row.name,
+        'description': row.description,
+        'postcode': row.postcode,
+        'lat': row.lat,
+        'lng': row.lng,
+        'average_rating': (round(average, 1)
+                           if average is not None else 'None')}
+
+
+def json_response(body):
+    """Return a JSON body as a response supporting conditional GETs."""
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.md5(body.encode('utf-8')).hexdigest())
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
 @bp.route('/locations')
 def locations():
-    """AJAX endpoint, return locations within 1 degree lat/lng as JSON."""
-    cur = get_db().cursor()
-    lat = request.args.get('lat')
-    min_lat = float(lat) - 1
-    max_lat = float(lat) + 1
-    lng = request.args.get('lng')
-    min_lng = float(lng) - 1
-    max_lng = float(lng) + 1
-
-    cur.execute("""
-        SELECT *
-        FROM locations
-        WHERE lat > %s AND lat < %s AND lng > %s AND lng < %s""",
-        (min_lat, max_lat, min_lng, max_lng))
-    locations = cur.fetchall()
-    results = [{
-        'id': row['id'],
-        'name': row['name'],
-        'description': row['description'],
-        'postcode': row['postcode']} for row in locations]
-    for result in results:
-        cur.execute("""
-            SELECT rating FROM reviews
-            WHERE location_id = %s""", str(result['id']))
-        ratings = cur.fetchall()
-        if ratings:
-            result['average_rating'] = round(
-                sum(rating['rating'] for rating in ratings)/len(ratings), 1)
-        else:
-            result['average_rating'] = 'None'
+    """AJAX endpoint, return locations near a lat/lng as JSON.
+
+    Without ``radius_km`` every location within 1 degree lat/lng is
+    returned. With it, only locations within that great-circle distance
+    are returned along with their ``distance_km``. ``order=nearest``
+    sorts results nearest first and ``limit`` caps the number returned.
+    ``stream=1`` streams the results from a server-side cursor rather than
+    building the whole response in memory, so ``limit`` may go up to
+    ``LOCATIONS_STREAM_MAX_LIMIT`` rather than ``LOCATIONS_MAX_LIMIT``.
+
+    Passing viewport bounds instead of a lat/lng returns a page of
+    results or clusters, see ``viewport_locations``.
+    """
+    if 'north' in request.args:
+        return viewport_locations()
+    try:
+        lat = float(request.args['lat'])
+        lng = float(request.args['lng'])
+        radius_km = request.args.get('radius_km', type=float)
+        limit = request.args.get('limit', type=int)
+    except (KeyError, ValueError):
+        abort(400)
+    # float() accepts 'nan' and 'inf', which can't be snapped to a tile
+    if not all(math.isfinite(value) for value in (lat, lng, radius_km or 0)):
+        abort(400)
+    order = request.args.get('order')
+    stream = bool(request.args.get('stream'))
+    max_limit = current_app.config['LOCATIONS_STREAM_MAX_LIMIT' if stream
+                                   else 'LOCATIONS_MAX_LIMIT']
+    limit = max_limit if limit is None else max(0, min(limit, max_limit))
+
+    if stream:
+        return stream_locations(lat, lng, radius_km, order, limit)
+    if radius_km is not None or order == 'nearest':
+        # Distances and ordering depend on the exact centre, don't cache
+        return json_response(dumps(list(nearby_locations(
+            lat, lng, radius_km, order, limit))))
+    # Snap the centre to a tile so visitors in the same area share a
+    # cached response
+    tile = current_app.config['LOCATIONS_TILE_SIZE']
+    lat, lng = round(lat / tile) * tile, round(lng / tile) * tile
+    key = (f'locations:{locations_generation()}:'
+           f'{lat:.6f}:{lng:.6f}:{order}:{limit}')
+    return json_response(cached(key, lambda: dumps(list(nearby_locations(
+        lat, lng, radius_km, order, limit)))))
+
+
+def stream_locations(lat, lng, radius_km, order, limit):
+    """Return a response streaming nearby locations as a JSON array.
+
+    Rows are fetched from a named (server-side) cursor
+    ``LOCATIONS_STREAM_ITERSIZE`` at a time and written out in chunks of
+    the same size, so memory use doesn't grow with the result set.
+    """
+    itersize = current_app.config['LOCATIONS_STREAM_ITERSIZE']
+
+    def generate():
+        chunk = []
+        first = True
+        for result in nearby_locations(lat, lng, radius_km, order, limit,
+                                       itersize):
+            chunk.append(dumps(result))
+            if len(chunk) == itersize:
+                yield ('[' if first else ',') + ','.join(chunk)
+                first = False
+                chunk = []
+        yield ('[' if first else ',') + ','.join(chunk) + ']'
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype='application/json')
+
+
+def nearby_locations(lat, lng, radius_km, order, limit, itersize=None):
+    """Yield the locations around a point as JSON objects."""
+    if radius_km is None:
+        bounds = lat - 1, lat + 1, lng - 1, lng + 1
+    else:
+        bounds = bounding_box(lat, lng, radius_km)
+    for row in queries.nearby_locations(lat, lng, bounds, radius_km,
+                                        order == 'nearest', limit, itersize):
+        result = location_json(row)
+        if radius_km is not None:
+            result['distance_km'] = round(row.distance_km, 3)
+        yield result
+
 
-    return json.dumps(results)
+def viewport_locations():
+    """Return the locations inside a map viewport as JSON.
+
+    Expects ``north``, ``south``, ``east`` and ``west`` bounds and the map
+    ``zoom``, which is clamped to 0 to ``MAX_ZOOM``. Below
+    ``LOCATIONS_CLUSTER_ZOOM``, or at any zoom with ``clusters=1``,
+    locations are aggregated into grid cells, returned as
+    ``{"clusters": [...]}`` with a count, centroid and mean rating per
+    cell. Otherwise ``{"results": [...], "next_cursor": ...}`` is
+    returned, ordered by id; pass ``next_cursor`` back as ``cursor`` to
+    fetch the following page.
+
+    Bounds are widened to the cell grid of the zoom level, so responses
+    can be cached per tile and clusters always cover whole cells.
+    """
+    try:
+        north = float(request.args['north'])
+        south = float(request.args['south'])
+        east = float(request.args['east'])
+        west = float(request.args['west'])
+        zoom = min(max(int(request.args['zoom']), 0), MAX_ZOOM)
+        cursor = int(request.args.get('cursor', 0))
+    except (KeyError, ValueError):
+        abort(400)
+    if (not all(map(math.isfinite, (north, south, east, west)))
+            or south > north):
+        abort(400)
+    # Web map tiles span 360 / 2**zoom degrees, split each into cells
+    cell = 360 / 2 ** zoom / 4
+    params = {'north': math.ceil(north / cell) * cell,
+              'south': math.floor(south / cell) * cell,
+              'east': math.ceil(east / cell) * cell,
+              'west': math.floor(west / cell) * cell,
+              'cell': cell, 'cursor': cursor}
+    clustered = (zoom < current_app.config['LOCATIONS_CLUSTER_ZOOM']
+                 or bool(request.args.get('clusters')))
+    key = ('viewport:{}:{}:{}:{south:.6f}:{north:.6f}:{west:.6f}:{east:.6f}:'
+           '{cursor}'.format(locations_generation(), zoom, int(clustered),
+                             **params))
+    return json_response(cached(key, lambda: dumps(
+        viewport_clusters(params) if clustered else viewport_page(params))))
+
+
+def viewport_clusters(params):
+    clusters = []
+    for row in queries.viewport_clusters(
+            params['north'], params['south'], params['east'],
+            params['west'], params['cell']):
+        average = average_rating(row.review_count, row.rating_sum)
+        clusters.append({
+            'count': row.count,
+            'lat': row.lat,
+            'lng': row.lng,
+            'average_rating': (round(average, 1)
+                               if average is not None else 'None')})
+    return {'clusters': clusters}
+
+
+def viewport_page(params):
+    page_size = current_app.config['LOCATIONS_PAGE_SIZE']
+    rows = queries.viewport_page(
+        params['north'], params['south'], params['east'], params['west'],
+        params['cursor'], page_size + 1)
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:-1]
+        next_cursor = rows[-1].id
+    return {'results': [location_json(row) for row in rows],
+            'next_cursor': next_cursor}
+
+
+@bp.route('/top')
+def top():
+    """AJAX endpoint, return the best rated places around a lat/lng.
+
+    Places are ordered by ``score``, a Bayesian average rating (see
+    ``db.ranking_row``), across the ``RANKING_PRECISION`` geohash cell
+    holding the point and the 8 cells around it. ``limit`` defaults to
+    and is capped at ``TOP_PLACES_LIMIT``.
+    """
+    try:
+        lat = float(request.args['lat'])
+        lng = float(request.args['lng'])
+        limit = request.args.get('limit', type=int)
+    except (KeyError, ValueError):
+        abort(400)
+    max_limit = current_app.config['TOP_PLACES_LIMIT']
+    limit = max_limit if limit is None else max(0, min(limit, max_limit))
+    cells = geohash_neighbours(lat, lng,
+                               current_app.config['RANKING_PRECISION'])
+    # Every point in a cell has the same neighbours and so the same results
+    key = f'top:{locations_generation()}:{cells[0]}:{limit}'
+    return json_response(cached(key, lambda: dumps([
+        dict(location_json(row), score=round(row.score, 3))
+        for row in queries.top_places(cells, limit)])))
 
 
 @bp.route('/add', methods=('GET', 'POST'))
 @login_required
 def add():
-    api_key = current_app.config.get('API_KEY')
-    gmaps = googlemaps.Client(key=api_key)
     if request.method == 'POST':
         name = request.form['name'].strip()
         description = request.form['description'].strip()
@@ -69,30 +269,28 @@ def add():
         error = None
         if not name or not description or not postcode:
             error = 'Name, description and postcode are required.'
-        # Calculate lat and lng from postcode
-        geocode_result = gmaps.geocode('components=postal_code:' + postcode)
-        if not geocode_result:
-            error = 'Error geocoding postcode.'
         else:
-            lat = geocode_result[0]['geometry']['location']['lat']
-            lng = geocode_result[0]['geometry']['location']['lng']
+            # Calculate lat and lng from postcode
+            coords = geocode(postcode)
+            if coords is None:
+                error = 'Error geocoding postcode.'
+            else:
+                lat, lng = coords
 
         if error is not None:
             flash(error)
         else:
             # Format postcode correctly for database
-            postcode = postcode.replace(' ', '')  # Remove all spaces
-            incode = postcode[len(postcode)-3:] # Last 3 characters
-            outcode = postcode[0:len(postcode)-3]  # Rest of postcode
-            postcode = f'{outcode} {incode}'
-            conn = get_db()
-            cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO locations (name, description, postcode,
-                                       user_id, lat, lng)
-                VALUES (%s, %s, %s, %s, %s, %s)""",
-                (name, description, postcode, g.user['id'], lat, lng))
-            conn.commit()
+            postcode = format_postcode(postcode)
+            if writer.enabled():
+                writer.write('location', name=name, description=description,
+                             postcode=postcode, user_id=g.user.id, lat=lat,
+                             lng=lng)
+            else:
+                queries.add_location(name, description, postcode, g.user.id,
+                                     lat, lng)
+                commit()
+            invalidate_locations()
             flash('Location added!')
             return redirect(url_for('places.index'))
     return render_template('places/add.html')
@@ -100,10 +298,18 @@ def add():
 
 @bp.route('/search', methods=('GET', 'POST'))
 def search():
+    """Full-text search over name and description, ranked by relevance.
+
+    Name and description terms are matched together against each place's
+    ``search_vector`` (names weigh more than descriptions), the postcode
+    is matched as a prefix. Results are paged ``SEARCH_PAGE_SIZE`` at a
+    time using the ``page`` form field.
+    """
     if request.method == 'POST':
         name = request.form['name']
         description = request.form['description']
         postcode = request.form['postcode']
+        page = max(request.form.get('page', 1, type=int), 1)
         error = None
         results = []
         if not name and not description and not postcode:
@@ -111,39 +317,29 @@ def search():
         if error is not None:
             flash(error)
         else:
-            conn = get_db()
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT *
-                FROM locations
-                WHERE name LIKE %s
-                    AND description LIKE %s
-                    AND postcode LIKE %s""",
-                (f'%{name}%', f'%{description}%', f'%{postcode}%'))
-            results = cur.fetchall()
+            page_size = current_app.config['SEARCH_PAGE_SIZE']
+            results = queries.search_locations(
+                f'{name} {description}'.strip(),
+                ' '.join(postcode.upper().split()),
+                page_size + 1, (page - 1) * page_size)
             if not results:
                 flash('Sorry, no results found.')
                 return render_template('places/search.html')
-            results = [dict(result) for result in results]
-            for result in results:
-                cur.execute("""
-                    SELECT rating FROM reviews
-                    WHERE location_id = %s""", str(result['id']))
-                ratings = cur.fetchall()
-                if ratings:
-                    result['average_rating'] = sum(
-                        rating['rating'] for rating in ratings)/len(ratings)
+            has_next = len(results) > page_size
+            results = [dict(result._asdict(), average_rating=average_rating(
+                           result.review_count, result.rating_sum))
+                       for result in results[:page_size]]
+            return render_template('places/search.html', results=results,
+                                   page=page, has_next=has_next)
         return render_template('places/search.html', results=results)
 
     return render_template('places/search.html')
 
 
-@bp.route('/place/<place_id>', methods=('GET', 'POST'))
+@bp.route('/place/<int:place_id>', methods=('GET', 'POST'))
 def place(place_id):
     """Details page for a single place."""
     api_key = current_app.config.get('API_KEY')
-    conn = get_db()
-    cur = conn.cursor()
     if request.method == 'POST':
         # Add review to the database
         rating = request.form['rating']
@@ -151,40 +347,86 @@ def place(place_id):
         error = None
         if not rating or not review:
             error = 'Rating and review are required.'
-        if not g.user['id']:
+        if not g.user:
             error = 'Sorry, you must be logged in to post a review.'
         if error is not None:
             flash(error)
         else:
-            cur.execute("""
-                INSERT INTO reviews (user_id, location_id, rating, review)
-                VALUES (%s, %s, %s, %s)""",
-                (g.user['id'], place_id, rating, review))
-            conn.commit()
+            # The rating summary is kept in step in the same transaction
+            if writer.enabled():
+                writer.write('review', user_id=g.user.id,
+                             location_id=place_id, rating=rating,
+                             review=review)
+            else:
+                queries.add_review(g.user.id, place_id, rating, review)
+                commit()
+            invalidate_place(place_id)
             flash('Review added!')
             return redirect(url_for('places.place', place_id=place_id))
     # Render place page
-    cur.execute("""
-        SELECT locations.name, locations.description, locations.postcode,
-               locations.lat, locations.lng, users.email
-        FROM locations
-            JOIN users ON locations.user_id=users.id
-        WHERE locations.id = %s""", (place_id,))
-    location = cur.fetchone()
-    if not location:
+    data = cached(f'place:{place_id}', lambda: place_data(place_id))
+    if data is None:
         flash('Sorry, that location page was not found.')
         return redirect(url_for('places.index'))
 
-    cur.execute("""
-        SELECT reviews.rating, reviews.review, users.email
-        FROM reviews
-            JOIN users ON reviews.user_id=users.id
-        WHERE location_id = %s""", place_id)
-    reviews = cur.fetchall()
-    average_rating = (
-        sum(review['rating'] for review in reviews)/len(reviews)
-        if reviews else 'None')
-
-    return render_template('places/place.html', location=dict(location),
-                           reviews=reviews, average_rating=average_rating,
-                           api_key=api_key)
+    # The page also depends on who is viewing it and their CSRF token
+    etag = hashlib.md5('{}:{}:{}:{}'.format(
+        place_id, data['updated_at'], session.get('user_id'),
+        session.get('_csrf_token')).encode('utf-8')).hexdigest()
+    last_modified = http_date(data['updated_at'])
+    if ('_flashes' not in session and not is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified)):
+        response = current_app.response_class(status=304)
+    else:
+        average = average_rating(data['location']['review_count'],
+                                 data['location']['rating_sum'])
+        response = make_response(render_template(
+            'places/place.html', location=data['location'],
+            reviews=data['reviews'], next_cursor=data['next_cursor'],
+            place_id=place_id,
+            average_rating=average if average is not None else 'None',
+            api_key=api_key))
+    response.set_etag(etag)
+    response.headers['Last-Modified'] = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def place_data(place_id):
+    """Return a place and its reviews as cacheable plain data."""
+    location = queries.place(place_id)
+    if not location:
+        return None
+    location = location._asdict()
+    updated_at = float(location.pop('updated_at'))
+
+    return dict(reviews_page(place_id), location=location,
+                updated_at=updated_at)
+
+
+@bp.route('/place/<int:place_id>/reviews')
+def reviews(place_id):
+    """AJAX endpoint, return a page of a place's reviews as JSON.
+
+    Reviews are ordered by id; pass the returned ``next_cursor`` back as
+    ``after`` to fetch the following page.
+    """
+    try:
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        abort(400)
+    return json_response(dumps(reviews_page(place_id, after)))
+
+
+def reviews_page(place_id, after=0):
+    """Return up to REVIEWS_PAGE_SIZE reviews with ids after ``after``."""
+    page_size = current_app.config['REVIEWS_PAGE_SIZE']
+    rows = [review._asdict()
+            for review in queries.reviews_page(place_id, after,
+                                               page_size + 1)]
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:-1]
+        next_cursor = rows[-1]['id']
+    return {'reviews': rows, 'next_cursor': next_cursor}
@@ -0,0 +1,305 @@
+"""SQL used by the views, prepared once per pooled connection.
+
+Statements are written with psycopg2 ``%(name)s`` placeholders, which are
+numbered for ``PREPARE``. Postgres infers the type of a parameter from
+where it is first used, so parameters in arithmetic are cast explicitly.
+Rows are named tuples: ``row.name`` in Python, while templates can use
+either ``row.name`` or ``row['name']``.
+"""
+import re
+
+from places.db import get_db, ranking_row
+from places.geo import EARTH_RADIUS_KM
+from places.metrics import InstrumentedTupleCursor
+
+PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+
+class Query:
+    """An SQL statement that is prepared on first use per connection."""
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        # Plain SELECTs may be served by a read replica
+        self.readonly = sql.lstrip().upper().startswith('SELECT')
+        self.params = []
+        for param in PLACEHOLDER.findall(sql):
+            if param not in self.params:
+                self.params.append(param)
+        numbered = PLACEHOLDER.sub(
+            lambda match: f'${self.params.index(match.group(1)) + 1}', sql)
+        self.prepare_sql = f'PREPARE {name} AS {numbered}'
+        self.execute_sql = f'EXECUTE {name}'
+        if self.params:
+            self.execute_sql += f' ({", ".join(["%s"] * len(self.params))})'
+
+    def execute(self, params=None):
+        """Run the statement on the request's connection, return a cursor."""
+        conn = get_db(readonly=self.readonly)
+        cur = conn.cursor(cursor_factory=InstrumentedTupleCursor)
+        if self.name not in conn.prepared:
+            # Prepared statements outlive transactions, so this is safe
+            # even if the transaction is later rolled back
+            cur.execute(self.prepare_sql)
+            conn.prepared.add(self.name)
+        cur.execute(self.execute_sql,
+                    [(params or {})[param] for param in self.params])
+        return cur
+
+    def stream(self, params, itersize):
+        """Run the statement from a server-side cursor and yield its rows.
+
+        ``DECLARE`` can't use a prepared statement, so the SQL is sent
+        as is.
+        """
+        conn = get_db(readonly=self.readonly)
+        with conn.cursor(name=self.name,
+                         cursor_factory=InstrumentedTupleCursor) as cur:
+            cur.itersize = itersize
+            cur.execute(self.sql, params)
+            yield from cur
+
+
+def _nearby_query(within, nearest):
+    # The box predicate is served by the (lat, lng) index, the radius
+    # check and sort then only run over rows inside the box
+    return Query(f'nearby_locations_{int(within)}{int(nearest)}', f"""
+        SELECT id, name, description, postcode, lat, lng, review_count,
+               rating_sum, distance_km
+        FROM (SELECT *, 2 * %(earth_radius)s::FLOAT8 * ASIN(SQRT(
+                  POWER(SIN(RADIANS(lat - %(lat)s::FLOAT8) / 2), 2) +
+                  COS(RADIANS(%(lat)s::FLOAT8)) * COS(RADIANS(lat)) *
+                  POWER(SIN(RADIANS(lng - %(lng)s::FLOAT8) / 2), 2)))
+                  AS distance_km
+              FROM locations
+              WHERE lat > %(min_lat)s AND lat < %(max_lat)s
+                  AND lng > %(min_lng)s AND lng < %(max_lng)s) AS nearby
+        {'WHERE distance_km <= %(radius_km)s' if within else ''}
+        {'ORDER BY distance_km, id' if nearest else ''}
+        LIMIT %(limit)s""")
+
+
+NEARBY_LOCATIONS = {(within, nearest): _nearby_query(within, nearest)
+                    for within in (False, True) for nearest in (False, True)}
+
+
+def nearby_locations(lat, lng, bounds, radius_km, nearest, limit,
+                     itersize=None):
+    """Return the rows of locations around a point.
+
+    ``bounds`` is the (min_lat, max_lat, min_lng, max_lng) box to search,
+    ``radius_km`` optionally limits results to that distance. Rows are
+    streamed from a server-side cursor when ``itersize`` is given.
+    """
+    min_lat, max_lat, min_lng, max_lng = bounds
+    query = NEARBY_LOCATIONS[radius_km is not None, nearest]
+    params = {'earth_radius': EARTH_RADIUS_KM, 'lat': lat, 'lng': lng,
+              'min_lat': min_lat, 'max_lat': max_lat,
+              'min_lng': min_lng, 'max_lng': max_lng,
+              'radius_km': radius_km, 'limit': limit}
+    if itersize:
+        return query.stream(params, itersize)
+    return query.execute(params)
+
+
+def _viewport_bounds(wraps):
+    # A viewport spanning the antimeridian has west > east
+    return f"""lat >= %(south)s AND lat <= %(north)s
+        AND (lng >= %(west)s {'OR' if wraps else 'AND'} lng <= %(east)s)"""
+
+
+VIEWPORT_CLUSTERS = {wraps: Query(f'viewport_clusters_{int(wraps)}', f"""
+    SELECT COUNT(*) AS count, AVG(lat) AS lat, AVG(lng) AS lng,
+           SUM(review_count) AS review_count,
+           SUM(rating_sum) AS rating_sum
+    FROM locations
+    WHERE {_viewport_bounds(wraps)}
+    GROUP BY FLOOR(lat / %(cell)s::FLOAT8), FLOOR(lng / %(cell)s::FLOAT8)""")
+    for wraps in (False, True)}
+
+VIEWPORT_PAGE = {wraps: Query(f'viewport_page_{int(wraps)}', f"""
+    SELECT id, name, description, postcode, lat, lng, review_count,
+           rating_sum
+    FROM locations
+    WHERE {_viewport_bounds(wraps)} AND id > %(cursor)s
+    ORDER BY id
+    LIMIT %(limit)s""")
+    for wraps in (False, True)}
+
+
+def viewport_clusters(north, south, east, west, cell):
+    """Return a row per grid cell of side ``cell`` holding locations."""
+    return VIEWPORT_CLUSTERS[west > east].execute(
+        {'north': north, 'south': south, 'east': east, 'west': west,
+         'cell': cell}).fetchall()
+
+
+def viewport_page(north, south, east, west, cursor, limit):
+    """Return up to limit locations in the bounds with ids after cursor."""
+    return VIEWPORT_PAGE[west > east].execute(
+        {'north': north, 'south': south, 'east': east, 'west': west,
+         'cursor': cursor, 'limit': limit}).fetchall()
+
+
+ADD_LOCATION = Query('add_location', """
+    INSERT INTO locations (name, description, postcode, user_id, lat, lng)
+    VALUES (%(name)s, %(description)s, %(postcode)s, %(user_id)s,
+            %(lat)s, %(lng)s)""")
+
+
+def add_location(name, description, postcode, user_id, lat, lng):
+    ADD_LOCATION.execute({'name': name, 'description': description,
+                          'postcode': postcode, 'user_id': user_id,
+                          'lat': lat, 'lng': lng})
+
+
+def escape_like(text):
+    """Escape LIKE wildcards so text is matched literally."""
+    return (text.replace('\\', '\\\\')
+            .replace('%', '\\%').replace('_', '\\_'))
+
+
+def _search_query(terms, postcode):
+    conditions = []
+    if terms:
+        conditions.append('search_vector @@ query')
+    if postcode:
+        conditions.append('postcode LIKE %(postcode)s')
+    return Query(f'search_locations_{int(terms)}{int(postcode)}', f"""
+        SELECT id, name, description, postcode, review_count, rating_sum,
+               ts_rank(search_vector, query) AS rank
+        FROM locations,
+             plainto_tsquery('pg_catalog.english', %(terms)s) AS query
+        WHERE {' AND '.join(conditions)}
+        ORDER BY rank DESC, postcode, id
+        LIMIT %(limit)s OFFSET %(offset)s""")
+
+
+SEARCH_LOCATIONS = {(terms, postcode): _search_query(terms, postcode)
+                    for terms in (False, True) for postcode in (False, True)
+                    if terms or postcode}
+
+
+def search_locations(terms, postcode_prefix, limit, offset):
+    """Return locations matching full-text terms and a postcode prefix.
+
+    Either may be empty but not both. The prefix is matched literally.
+    """
+    query = SEARCH_LOCATIONS[bool(terms), bool(postcode_prefix)]
+    return query.execute({
+        'terms': terms,
+        'postcode': escape_like(postcode_prefix) + '%',
+        'limit': limit, 'offset': offset}).fetchall()
+
+
+ADD_REVIEW = Query('add_review', """
+    INSERT INTO reviews (user_id, location_id, rating, review)
+    VALUES (%(user_id)s, %(location_id)s, %(rating)s, %(review)s)""")
+
+ADD_TO_RATING_SUMMARY = Query('add_to_rating_summary', """
+    UPDATE locations
+    SET review_count = review_count + 1,
+        rating_sum = rating_sum + %(rating)s::INTEGER,
+        updated_at = NOW()
+    WHERE id = %(location_id)s
+    RETURNING id, lat, lng, review_count, rating_sum""")
+
+SET_RANKING = Query('set_ranking', """
+    INSERT INTO place_rankings (cell, location_id, score)
+    VALUES (%(cell)s, %(location_id)s, %(score)s)
+    ON CONFLICT (cell, location_id) DO UPDATE SET score = EXCLUDED.score""")
+
+
+def add_review(user_id, location_id, rating, review):
+    """Insert a review and update its location's summary and ranking."""
+    params = {'user_id': user_id, 'location_id': location_id,
+              'rating': rating, 'review': review}
+    ADD_REVIEW.execute(params)
+    summary = ADD_TO_RATING_SUMMARY.execute(params).fetchone()
+    cell, location_id, score = ranking_row(*summary)
+    SET_RANKING.execute({'cell': cell, 'location_id': location_id,
+                         'score': score})
+
+
+# Reads the best few of each cell from place_rankings_score_idx, so the
+# cost doesn't grow with the number of places in the cells
+TOP_PLACES = Query('top_places', """
+    SELECT locations.id, locations.name, locations.description,
+           locations.postcode, locations.lat, locations.lng,
+           locations.review_count, locations.rating_sum, top.score
+    FROM unnest(%(cells)s::TEXT[]) AS cells (cell)
+        CROSS JOIN LATERAL (
+            SELECT location_id, score
+            FROM place_rankings
+            WHERE place_rankings.cell = cells.cell
+            ORDER BY score DESC, location_id
+            LIMIT %(limit)s) AS top
+        JOIN locations ON locations.id = top.location_id
+    ORDER BY top.score DESC, locations.id
+    LIMIT %(limit)s""")
+
+
+def top_places(cells, limit):
+    """Return the highest scoring places across geohash cells."""
+    return TOP_PLACES.execute({'cells': cells, 'limit': limit}).fetchall()
+
+
+PLACE = Query('place', """
+    SELECT locations.name, locations.description, locations.postcode,
+           locations.lat, locations.lng, locations.review_count,
+           locations.rating_sum, users.email,
+           EXTRACT(EPOCH FROM locations.updated_at) AS updated_at
+    FROM locations
+        JOIN users ON locations.user_id = users.id
+    WHERE locations.id = %(id)s""")
+
+
+def place(place_id):
+    """Return a location with its author's email, or None."""
+    return PLACE.execute({'id': place_id}).fetchone()
+
+
+# Served by the reviews (location_id, id) index
+REVIEWS_PAGE = Query('reviews_page', """
+    SELECT reviews.id, reviews.rating, reviews.review, users.email
+    FROM reviews
+        JOIN users ON reviews.user_id = users.id
+    WHERE location_id = %(location_id)s AND reviews.id > %(after)s
+    ORDER BY reviews.id
+    LIMIT %(limit)s""")
+
+
+def reviews_page(place_id, after, limit):
+    """Return up to limit of a place's reviews with ids after ``after``."""
+    return REVIEWS_PAGE.execute({'location_id': place_id, 'after': after,
+                                 'limit': limit}).fetchall()
+
+
+USER_BY_ID = Query('user_by_id', """
+    SELECT id, email FROM users WHERE id = %(id)s""")
+
+USER_BY_EMAIL = Query('user_by_email', """
+    SELECT id, email, password FROM users WHERE email = %(email)s""")
+
+ADD_USER = Query('add_user', """
+    INSERT INTO users (email, password) VALUES (%(email)s, %(password)s)""")
+
+SET_PASSWORD = Query('set_password', """
+    UPDATE users SET password = %(password)s WHERE id = %(id)s""")
+
+
+def user_by_id(user_id):
+    return USER_BY_ID.execute({'id': user_id}).fetchone()
+
+
+def user_by_email(email):
+    return USER_BY_EMAIL.execute({'email': email}).fetchone()
+
+
+def add_user(email, password_hash):
+    ADD_USER.execute({'email': email, 'password': password_hash})
+
+
+def set_password(user_id, password_hash):
+    SET_PASSWORD.execute({'id': user_id, 'password': password_hash})
@@ -1,6 +1,10 @@
 DROP TABLE IF EXISTS users CASCADE;
 DROP TABLE IF EXISTS locations CASCADE;
 DROP TABLE IF EXISTS reviews CASCADE;
+DROP TABLE IF EXISTS geocode_cache CASCADE;
+DROP TABLE IF EXISTS email_outbox CASCADE;
+DROP TABLE IF EXISTS import_checkpoints CASCADE;
+DROP TABLE IF EXISTS place_rankings CASCADE;
 
 CREATE TABLE users (
     id SERIAL PRIMARY KEY,
@@ -16,9 +20,51 @@ CREATE TABLE locations (
     postcode TEXT NOT NULL,
     lat REAL NOT NULL,
     lng REAL NOT NULL,
+    -- Rating summary, kept in step with reviews (see rebuild-ratings)
+    review_count INTEGER NOT NULL DEFAULT 0,
+    rating_sum INTEGER NOT NULL DEFAULT 0,
+    -- Name and description lexemes, set by locations_search_update
+    search_vector TSVECTOR,
+    -- Last change to the place or its reviews, for Last-Modified headers
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
     FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
 );
 
+-- Serves the lat/lng bounding-box scan behind /locations
+CREATE INDEX locations_lat_lng_idx ON locations (lat, lng);
+
+-- Full-text search over name (weight A) and description (weight B)
+CREATE OR REPLACE FUNCTION locations_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('pg_catalog.english', NEW.name), 'A') ||
+        setweight(to_tsvector('pg_catalog.english', NEW.description), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER locations_search_update
+    BEFORE INSERT OR UPDATE OF name, description ON locations
+    FOR EACH ROW EXECUTE PROCEDURE locations_search_vector();
+
+CREATE INDEX locations_search_idx ON locations USING GIN (search_vector);
+
+-- Postcode prefix search uses a trigram index where pg_trgm is available
+-- and a pattern-matching B-tree index otherwise
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions
+               WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX locations_postcode_idx
+            ON locations USING GIN (postcode gin_trgm_ops);
+    ELSE
+        CREATE INDEX locations_postcode_idx
+            ON locations (postcode text_pattern_ops);
+    END IF;
+END
+$$;
+
 CREATE TABLE reviews (
     id SERIAL PRIMARY KEY,
     user_id INTEGER NOT NULL,
@@ -28,3 +74,52 @@ CREATE TABLE reviews (
     FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
     FOREIGN KEY (location_id) REFERENCES locations (id) ON DELETE CASCADE
 );
+
+-- Keyset pagination of a place's reviews
+CREATE INDEX reviews_location_id_idx ON reviews (location_id, id);
+
+-- Reviewed places by geohash cell with a Bayesian average score, kept in
+-- step with reviews (see rebuild-rankings)
+CREATE TABLE place_rankings (
+    cell TEXT NOT NULL,
+    location_id INTEGER NOT NULL,
+    score DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (cell, location_id),
+    FOREIGN KEY (location_id) REFERENCES locations (id) ON DELETE CASCADE
+);
+
+-- Top places per cell for /top
+CREATE INDEX place_rankings_score_idx
+    ON place_rankings (cell, score DESC, location_id);
+
+-- Geocoder results keyed by postcode without spaces, NULL lat/lng
+-- records a postcode the geocoder could not find
+CREATE TABLE geocode_cache (
+    postcode TEXT PRIMARY KEY,
+    lat REAL,
+    lng REAL,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- Emails waiting to be sent by the email-worker command
+CREATE TABLE email_outbox (
+    id SERIAL PRIMARY KEY,
+    subject TEXT NOT NULL,
+    sender TEXT,
+    recipients TEXT NOT NULL,
+    text_body TEXT NOT NULL,
+    html_body TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX email_outbox_pending_idx ON email_outbox (next_attempt_at)
+    WHERE sent_at IS NULL;
+
+-- Records loaded so far from each file by the import-data command
+CREATE TABLE import_checkpoints (
+    source TEXT PRIMARY KEY,
+    records INTEGER NOT NULL
+);
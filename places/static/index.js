@@ -1,55 +1,102 @@
-let geocoder;
 let map;
+let markers = [];
+// Incremented on every viewport change so stale pages are dropped
+let viewportRequest = 0;
 
 // AJAX request to GET /locations
-// returns locations as JSON near a given latlng
-function getLocations(latlng) {
-    return fetch(`/locations?lat=${latlng.lat}&lng=${latlng.lng}`)
+// returns a page of locations, or clusters at low zoom or when asked for,
+// within bounds
+function getLocations(bounds, zoom, cursor, clusters) {
+    let ne = bounds.getNorthEast();
+    let sw = bounds.getSouthWest();
+    let url = `/locations?north=${ne.lat()}&south=${sw.lat()}` +
+              `&east=${ne.lng()}&west=${sw.lng()}&zoom=${zoom}`;
+    if (cursor) {
+        url += `&cursor=${cursor}`;
+    }
+    if (clusters) {
+        url += '&clusters=1';
+    }
+    return fetch(url)
     .then(response => response.json())
     .catch(error => console.error(error));
 }
 
 function initMap(latlng) {
-    geocoder = new google.maps.Geocoder();
     map = new google.maps.Map(
         document.getElementById('map'), {center: latlng, zoom: 11});
+    map.addListener('idle', loadViewport);
 }
 
-function addElement(element) {
-    geocoder.geocode(
-        {'address': element.postcode},
-        function(results, status) {
-            if (status == 'OK') {
-                let marker = new google.maps.Marker({
-                    map: map,
-                    position: results[0].geometry.location
-                });
-                // Add clickable infoWindow for each element
-                let href = `/place/${element.id}`
-                let infoWindow = new google.maps.InfoWindow({
-                    content: `
-                        <a href=${href}><h3>${element.name}</h3></a>
-                        <span>Average rating: ${element.average_rating}</span>
-                        <ul>
-                            <li>${element.description}
-                            <li>${element.postcode}
-                        </ul>`
-                });
-                marker.addListener('click', function() {
-                    infoWindow.open(map, marker);
-                });
+function clearMarkers() {
+    markers.forEach(marker => marker.setMap(null));
+    markers = [];
+}
+
+// Show the places in the current viewport, or clusters of them when
+// they don't fit on one page, so each pan fetches a bounded amount
+function loadViewport() {
+    let request = ++viewportRequest;
+    let bounds = map.getBounds();
+    let zoom = map.getZoom();
+    clearMarkers();
+    function show(clusters) {
+        getLocations(bounds, zoom, null, clusters).then(function(result) {
+            if (!result || request != viewportRequest) {
+                return;
+            }
+            if (result.clusters) {
+                result.clusters.forEach(cluster => addCluster(cluster));
+            } else if (result.next_cursor) {
+                show(true);
             } else {
-                alert('Geocode was not successful: ' + status);
+                result.results.forEach(element => addElement(element));
             }
-        }
-    );
+        });
+    }
+    show(false);
+}
+
+// Add a marker summarising several places, zooming in on click
+function addCluster(cluster) {
+    let marker = new google.maps.Marker({
+        map: map,
+        position: {lat: cluster.lat, lng: cluster.lng},
+        label: String(cluster.count),
+        title: `${cluster.count} places, ` +
+               `average rating: ${cluster.average_rating}`
+    });
+    marker.addListener('click', function() {
+        map.setCenter(marker.getPosition());
+        map.setZoom(map.getZoom() + 2);
+    });
+    markers.push(marker);
+}
+
+function addElement(element) {
+    let marker = new google.maps.Marker({
+        map: map,
+        position: {lat: element.lat, lng: element.lng}
+    });
+    // Add clickable infoWindow for each element
+    let href = `/place/${element.id}`
+    let infoWindow = new google.maps.InfoWindow({
+        content: `
+            <a href=${href}><h3>${element.name}</h3></a>
+            <span>Average rating: ${element.average_rating}</span>
+            <ul>
+                <li>${element.description}
+                <li>${element.postcode}
+            </ul>`
+    });
+    marker.addListener('click', function() {
+        infoWindow.open(map, marker);
+    });
+    markers.push(marker);
 }
 
 navigator.geolocation.getCurrentPosition(function(position) {
     let latlng = {lat: position.coords.latitude,
                   lng: position.coords.longitude};
     initMap(latlng);
-    getLocations(latlng).then(function(result) {
-        result.forEach(element => addElement(element));
-    });
 });
@@ -1,41 +1,60 @@
 let map;
-let geocoder;
 
-// Takes an element with postcode, id, name & description attributes
+// element is an object with lat, lng, name, description & postcode
 function addElement(element) {
-    geocoder.geocode(
-        {'address': element.postcode},
-            function(results, status) {
-            if (status == 'OK') {
-                let marker = new google.maps.Marker({
-                    map: map,
-                    position: results[0].geometry.location
-                });
-                // Add clickable infoWindow for each element
-                let href = `/place/${element.id}`
-                let infoWindow = new google.maps.InfoWindow({
-                    content: `
-                        <h3>${element.name}</h3>
-                        <ul>
-                            <li>${element.description}
-                            <li>${element.postcode}
-                        </ul>`
-                });
-                marker.addListener('click', function() {
-                    infoWindow.open(map, marker);
-                });
-            } else {
-                alert('Geocode was not successful: ' + status);
-            }
-        }
-    );
+    let marker = new google.maps.Marker({
+        map: map,
+        position: {lat: element.lat, lng: element.lng}
+    });
+    // Add clickable infoWindow for each element
+    let infoWindow = new google.maps.InfoWindow({
+        content: `
+            <h3>${element.name}</h3>
+            <ul>
+                <li>${element.description}
+                <li>${element.postcode}
+            </ul>`
+    });
+    marker.addListener('click', function() {
+        infoWindow.open(map, marker);
+    });
 }
 
 function initMap(latlng) {
-    geocoder = new google.maps.Geocoder();
     map = new google.maps.Map(
         document.getElementById('place-map'), {center: latlng, zoom: 15});
     addElement(element);
 }
 
+// Append the next page of reviews each time "More reviews" is clicked
+function loadMoreReviews(button) {
+    fetch(`${button.dataset.url}?after=${button.dataset.cursor}`)
+    .then(response => response.json())
+    .then(function(result) {
+        let container = document.getElementById('reviews');
+        result.reviews.forEach(function(review) {
+            let div = document.createElement('div');
+            let heading = document.createElement('h4');
+            heading.textContent = `${review.email} says:`;
+            let rating = document.createElement('span');
+            rating.textContent = `Rating: ${review.rating}`;
+            let text = document.createElement('span');
+            text.textContent = review.review;
+            div.append(heading, rating, document.createElement('br'), text);
+            container.appendChild(div);
+        });
+        if (result.next_cursor) {
+            button.dataset.cursor = result.next_cursor;
+        } else {
+            button.remove();
+        }
+    })
+    .catch(error => console.error(error));
+}
+
+let moreReviews = document.getElementById('more-reviews');
+if (moreReviews) {
+    moreReviews.addEventListener('click', () => loadMoreReviews(moreReviews));
+}
+
 initMap(latlng);
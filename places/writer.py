@@ -0,0 +1,198 @@
+"""Group commit of reviews and places written under burst load.
+
+With WRITE_BATCHING set, views hand their inserts to a writer thread per
+process instead of committing themselves. The writer collects writes
+for up to WRITE_BATCH_WINDOW milliseconds or WRITE_BATCH_SIZE writes,
+inserts each kind with one multi-row statement and commits once. Each
+request waits until the commit holding its write has returned, so it is
+only acknowledged once the write is durable.
+
+If a batch fails its writes are retried one transaction each, so only
+the requests whose own writes fail see the error.
+"""
+from collections import defaultdict
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+import psycopg2
+from psycopg2.extras import execute_values
+
+from places.db import Connection, mark_written
+from places.importer import insert_reviews
+from places.metrics import SIZE_BUCKETS, InstrumentedCursor, get_registry
+
+_writer_lock = threading.Lock()
+
+
+class WriteTimeout(Exception):
+    """A write wasn't committed within WRITE_BATCH_TIMEOUT seconds."""
+
+
+class _Write:
+
+    def __init__(self, kind, record):
+        self.kind = kind
+        self.record = record
+        self.submitted = time.monotonic()
+        self.done = threading.Event()
+        self.error = None
+
+
+def _insert_locations(cur, records):
+    execute_values(cur, """
+        INSERT INTO locations (name, description, postcode, user_id,
+                               lat, lng)
+        VALUES %s""",
+        [(record['name'], record['description'], record['postcode'],
+          record['user_id'], record['lat'], record['lng'])
+         for record in records],
+        page_size=len(records))
+
+
+INSERTS = {'location': _insert_locations, 'review': insert_reviews}
+
+
+class BatchWriter:
+    """A thread committing the writes submitted to it in batches.
+
+    It has a connection of its own rather than one from the pool, as the
+    requests waiting on it may hold every pooled connection.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.conn = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='places-writer')
+        self.thread.start()
+
+    def submit(self, kind, record):
+        """Queue a write and block until it is committed.
+
+        Raises the write's database error if it failed.
+        """
+        write = _Write(kind, record)
+        self.queue.put(write)
+        if not write.done.wait(self.app.config['WRITE_BATCH_TIMEOUT']):
+            raise WriteTimeout(f'{kind} write not committed in time.')
+        if write.error is not None:
+            raise write.error
+
+    def close(self):
+        """Commit the writes already submitted and stop the thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        batch = []
+        write = self.queue.get()
+        deadline = time.monotonic() + (
+            self.app.config['WRITE_BATCH_WINDOW'] / 1000)
+        while write is not None:
+            batch.append(write)
+            remaining = deadline - time.monotonic()
+            if (len(batch) >= self.app.config['WRITE_BATCH_SIZE']
+                    or remaining <= 0):
+                return batch
+            try:
+                write = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                return batch
+        self.stopping = True
+        return batch
+
+    def _run(self):
+        while not self.stopping:
+            batch = self._collect()
+            if batch:
+                with self.app.app_context():
+                    self._flush(batch)
+        if self.conn is not None:
+            self.conn.close()
+
+    def _connection(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(
+                self.app.config['DATABASE'], connection_factory=Connection,
+                cursor_factory=InstrumentedCursor)
+        return self.conn
+
+    def _commit(self, writes):
+        conn = self._connection()
+        try:
+            kinds = defaultdict(list)
+            for write in writes:
+                kinds[write.kind].append(write.record)
+            with conn.cursor() as cur:
+                for kind, records in kinds.items():
+                    INSERTS[kind](cur, records)
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+    def _flush(self, batch):
+        registry = get_registry()
+        kinds = defaultdict(int)
+        for write in batch:
+            kinds[write.kind] += 1
+        for kind, size in kinds.items():
+            registry.observe('places_write_batch_size', {'kind': kind}, size,
+                             SIZE_BUCKETS)
+        try:
+            self._commit(batch)
+        except Exception:
+            current_app.logger.exception(
+                'Batch of %d writes failed, retrying one by one', len(batch))
+            registry.inc('places_write_batch_failures_total', {})
+            for write in batch:
+                try:
+                    self._commit([write])
+                except Exception as e:
+                    write.error = e
+        now = time.monotonic()
+        for write in batch:
+            registry.observe('places_write_wait_seconds',
+                             {'kind': write.kind}, now - write.submitted)
+            write.done.set()
+
+
+def get_writer(app=None):
+    """Return the writer for this app and process, starting it if needed.
+
+    Like the connection pool it is created lazily, so each forked worker
+    starts its own thread.
+    """
+    app = app or current_app._get_current_object()
+    writer = app.extensions.get('writer')
+    if writer is not None and writer.pid == os.getpid():
+        return writer
+    with _writer_lock:
+        writer = app.extensions.get('writer')
+        if writer is None or writer.pid != os.getpid():
+            writer = BatchWriter(app)
+            app.extensions['writer'] = writer
+        return writer
+
+
+def enabled():
+    """Whether writes go through the batch writer.
+
+    Transactional tests share one uncommitted connection, which the
+    writer's own connection couldn't see, so batching is off for them.
+    """
+    config = current_app.config
+    return config['WRITE_BATCHING'] and not config['TEST_TRANSACTIONAL']
+
+
+def write(kind, **record):
+    """Commit a ``location`` or ``review`` through the batch writer."""
+    get_writer().submit(kind, record)
+    mark_written()